@@ -15,14 +15,17 @@ class StockAdmin(admin.ModelAdmin):
 class OrderAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "stock", "order_type", "price", "quantity", "remaining_quantity", "status", "timestamp")
     list_filter = ("order_type", "status", "stock")
+    list_select_related = ("user", "stock")
     search_fields = ("user__username", "stock__name")
 
 @admin.register(Trade)
 class TradeAdmin(admin.ModelAdmin):
-    list_display = ("id", "stock", "price", "quantity", "timestamp")
+    list_display = ("id", "stock", "buyer", "seller", "price", "quantity", "timestamp")
+    list_select_related = ("stock", "buyer", "seller")
     search_fields = ("stock__name",)
 
 @admin.register(UserHolding)
 class HoldingAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "stock", "quantity", "avg_price")
+    list_select_related = ("user", "stock")
     search_fields = ("user__username", "stock__name")
@@ -0,0 +1,126 @@
+"""
+Async order entry and live event streaming.
+
+These are plain Django async views so that, served over ASGI, a waiting
+order or an idle stream is a suspended coroutine rather than a blocked
+worker thread. They authenticate with the same cached token backend as the
+DRF views.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework import exceptions, serializers
+
+from .authentication import CachedTokenAuthentication
+from .events import broker, stock_topic, user_topic
+from .sequencer import submit_order
+from .serializers import OrderSerializer
+
+# Seconds between keep-alive comments on an idle stream.
+HEARTBEAT_SECONDS = 15
+
+
+def _authenticate(request):
+    try:
+        result = CachedTokenAuthentication().authenticate(request)
+    except exceptions.AuthenticationFailed as exc:
+        return None, str(exc.detail)
+    if result is None:
+        return None, "Authentication credentials were not provided."
+    return result[0], None
+
+
+class _SerializerRequest:
+    def __init__(self, user):
+        self.user = user
+
+
+def _place_order(user, data):
+    serializer = OrderSerializer(data=data, context={"request": _SerializerRequest(user)})
+    if not serializer.is_valid():
+        return None, serializer.errors
+    try:
+        order = serializer.save(user=user, remaining_quantity=serializer.validated_data["quantity"])
+    except serializers.ValidationError as e:
+        return None, e.detail
+    return order, None
+
+
+@csrf_exempt
+@require_POST
+async def order_entry(request):
+    """POST /api/async/orders/: place an order and await its match without holding a thread."""
+    user, error = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return JsonResponse({"detail": error}, status=401)
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"detail": "Invalid JSON."}, status=400)
+
+    try:
+        order, errors = await sync_to_async(_place_order)(user, data)
+    except Exception as e:
+        return JsonResponse({"error": f"Order creation failed: {str(e)}"}, status=500)
+    if order is None:
+        return JsonResponse(errors, status=400)
+    accepted = OrderSerializer(order).data
+
+    future = await sync_to_async(submit_order)(order)
+    try:
+        order = await asyncio.wait_for(
+            asyncio.wrap_future(future), getattr(settings, "MATCHING_TIMEOUT", 5)
+        )
+    except asyncio.TimeoutError:
+        return JsonResponse(accepted, status=202, encoder=DjangoJSONEncoder)
+    except Exception as e:
+        return JsonResponse({"error": f"Order creation failed: {str(e)}"}, status=500)
+    return JsonResponse(OrderSerializer(order).data, status=201, encoder=DjangoJSONEncoder)
+
+
+def _sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def _stream(subscription):
+    try:
+        yield ": connected\n\n"
+        while True:
+            try:
+                event = await subscription.get(timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                return
+            yield _sse(event)
+    finally:
+        subscription.close()
+
+
+@require_GET
+async def event_stream(request):
+    """
+    GET /api/stream/?stocks=1,2: Server-Sent Events with the caller's fills
+    and order updates, plus trades and book updates for the listed stocks.
+    """
+    user, error = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return JsonResponse({"detail": error}, status=401)
+    try:
+        stock_ids = [int(pk) for pk in request.GET.get("stocks", "").split(",") if pk]
+    except ValueError:
+        return JsonResponse({"detail": "query param 'stocks' must be comma-separated ids"}, status=400)
+
+    topics = [user_topic(user.pk)] + [stock_topic(pk) for pk in stock_ids]
+    subscription = broker.subscribe(topics)
+    response = StreamingHttpResponse(_stream(subscription), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
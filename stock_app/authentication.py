@@ -0,0 +1,127 @@
+"""
+Token authentication with a cache in front of the authtoken lookup.
+
+Resolved tokens (with their user) are kept in a per-process LRU with a
+TTL and, optionally, in a shared Django cache so other processes benefit
+too. Entries are dropped when a token is deleted or rotated, when the user
+is saved, and when settlement changes the user's balance, so
+``request.user`` is the same as an uncached lookup would give.
+
+Configured by the ``TOKEN_AUTH_CACHE`` setting::
+
+    TOKEN_AUTH_CACHE = {
+        "TTL": 60,              # seconds an entry may be served
+        "MAX_SIZE": 10000,      # entries in the local LRU
+        "SHARED_CACHE": None,   # alias in CACHES, e.g. "default"
+    }
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+DEFAULTS = {"TTL": 60, "MAX_SIZE": 10000, "SHARED_CACHE": None}
+
+
+def _config():
+    return {**DEFAULTS, **getattr(settings, "TOKEN_AUTH_CACHE", {})}
+
+
+class TokenCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+
+    def _shared(self):
+        alias = _config()["SHARED_CACHE"]
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, token = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return token
+                self._forget(key)
+        shared = self._shared()
+        if shared is not None:
+            token = shared.get(f"authtoken:{key}")
+            if token is not None:
+                self._remember(key, token)
+                return token
+        return None
+
+    def set(self, key, token):
+        self._remember(key, token)
+        shared = self._shared()
+        if shared is not None:
+            ttl = _config()["TTL"]
+            shared.set(f"authtoken:{key}", token, ttl)
+            user_key = f"authtoken:user:{token.user_id}"
+            shared.set(user_key, list({*(shared.get(user_key) or ()), key}), ttl)
+
+    def _remember(self, key, token):
+        config = _config()
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (time.monotonic() + config["TTL"], token)
+            self._keys_by_user.setdefault(token.user_id, set()).add(key)
+            while len(self._entries) > config["MAX_SIZE"]:
+                self._forget(next(iter(self._entries)))
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            user_id = entry[1].user_id
+            keys = self._keys_by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_user[user_id]
+
+    def invalidate_key(self, key):
+        with self._lock:
+            self._forget(key)
+        shared = self._shared()
+        if shared is not None:
+            shared.delete(f"authtoken:{key}")
+
+    def invalidate_users(self, user_ids):
+        shared = self._shared()
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._keys_by_user.get(user_id, ())):
+                    self._forget(key)
+        if shared is not None:
+            for user_id in user_ids:
+                user_key = f"authtoken:user:{user_id}"
+                keys = shared.get(user_key) or []
+                shared.delete_many([f"authtoken:{key}" for key in keys] + [user_key])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """``TokenAuthentication`` that only hits the database on a cache miss."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token)
+        # Each request gets its own user object; views and settlement
+        # update fields such as balance on request.user.
+        return copy.copy(token.user), token
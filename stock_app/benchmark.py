@@ -0,0 +1,243 @@
+"""
+Synthetic order-flow benchmark for the matching engine.
+
+Seeds users, stocks and a resting book, then replays one order flow per
+scenario through either the engine directly ("engine") or the order API
+("api"), recording per-order latency and query counts, optionally with
+reader threads polling GET /api/stocks/ to measure how much order writes
+hold up reads. Used by the ``bench_matching`` management command.
+"""
+import math
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+
+from .models import Order, Stock, UserHolding
+from .orderbook import reset_books
+from .risk import accounts
+from .services import cancel_order, match_orders
+
+User = get_user_model()
+
+SCENARIOS = ("non-crossing", "crossing", "sweep", "cancel-heavy")
+MID = 100
+
+
+class QueryCounter:
+    """Cheap execute_wrapper that only counts statements."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Readers:
+    """
+    Threads polling GET /api/stocks/ for as long as the context is open,
+    with Cache-Control: no-cache so every read reaches the database.
+    """
+
+    def __init__(self, count, user):
+        self.count = count
+        self.user = user
+        self.latencies = []
+        self.errors = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        for _ in range(self.count):
+            thread = threading.Thread(target=self._read, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self._started
+
+    def _read(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                if client.get("/api/stocks/", HTTP_CACHE_CONTROL="no-cache").status_code != 200:
+                    self.errors += 1
+                self.latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            "readers": self.count,
+            "reads_per_sec": len(latencies) / self.elapsed if self.elapsed else 0.0,
+            "read_p50_ms": percentile(latencies, 0.50) * 1000,
+            "read_p99_ms": percentile(latencies, 0.99) * 1000,
+            "read_errors": self.errors,
+        }
+
+
+def summarize(scenario, path, latencies, queries):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        "scenario": scenario,
+        "path": path,
+        "orders": len(latencies),
+        "orders_per_sec": len(latencies) / total if total else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+        "queries_per_order": sum(queries) / len(queries) if queries else 0.0,
+    }
+
+
+class Benchmark:
+    def __init__(self, users=20, stocks=5, resting=1000, orders=500, sweep_depth=50, seed=1):
+        self.rng = random.Random(seed)
+        self.n_users = users
+        self.n_stocks = stocks
+        self.resting = resting
+        self.orders = orders
+        self.sweep_depth = sweep_depth
+        self.open_orders = []
+
+    def seed(self):
+        reset_books()
+        accounts.clear()
+        self.users = User.objects.bulk_create([
+            User(username=f"bench{i}", email=f"bench{i}@example.com", balance=Decimal("1000000000.00"))
+            for i in range(self.n_users)
+        ])
+        self.stocks = Stock.objects.bulk_create([
+            Stock(name=f"BENCH{i}", current_price=MID) for i in range(self.n_stocks)
+        ])
+        UserHolding.objects.bulk_create([
+            UserHolding(user=user, stock=stock, quantity=10 ** 9, avg_price=MID)
+            for user in self.users for stock in self.stocks
+        ])
+        self.rest(self.resting)
+
+    def order(self, order_type, price, quantity, stock=None):
+        return Order(
+            user=self.rng.choice(self.users),
+            stock=stock or self.rng.choice(self.stocks),
+            order_type=order_type,
+            price=Decimal(price),
+            quantity=quantity,
+            remaining_quantity=quantity,
+        )
+
+    def rest(self, count, stock=None, side=None, quantity=None):
+        """Add non-crossing resting orders: bids below the mid, asks above."""
+        orders = []
+        for _ in range(count):
+            offset = self.rng.randint(1, 50)
+            order_type = side or self.rng.choice((Order.BUY, Order.SELL))
+            price = MID - offset if order_type == Order.BUY else MID + offset
+            orders.append(self.order(order_type, price, quantity or self.rng.randint(1, 10), stock))
+        self.open_orders.extend(Order.objects.bulk_create(orders))
+
+    def flow(self, scenario):
+        """
+        Yield ``(prepare, order, cancel)``; ``prepare`` runs untimed before
+        the order is sent, or cancelled when ``cancel`` is set.
+        """
+        for _ in range(self.orders):
+            side = self.rng.choice((Order.BUY, Order.SELL))
+            opposite = Order.SELL if side == Order.BUY else Order.BUY
+            if scenario == "non-crossing":
+                offset = self.rng.randint(1, 50)
+                price = MID - offset if side == Order.BUY else MID + offset
+                yield None, self.order(side, price, self.rng.randint(1, 10)), False
+            elif scenario == "crossing":
+                price = MID + 50 if side == Order.BUY else MID - 50
+                yield None, self.order(side, price, 1), False
+            elif scenario == "sweep":
+                # Top up the opposite side with enough single-share orders
+                # that the sweep fills completely against up to sweep_depth of them.
+                stock = self.rng.choice(self.stocks)
+                price = MID + 50 if side == Order.BUY else MID - 50
+                prepare = lambda stock=stock, opposite=opposite: self.rest(
+                    self.sweep_depth, stock, side=opposite, quantity=1
+                )
+                yield prepare, self.order(side, price, self.sweep_depth, stock), False
+            elif scenario == "cancel-heavy":
+                # A market maker requoting: cancel a random resting order,
+                # with a fresh quote (untimed) keeping the book the same size.
+                index = self.rng.randrange(len(self.open_orders))
+                self.open_orders[index], self.open_orders[-1] = self.open_orders[-1], self.open_orders[index]
+                yield (lambda: self.rest(1)), self.open_orders.pop(), True
+            else:
+                raise ValueError(f"Unknown scenario {scenario!r}")
+
+    def run(self, scenario, path="engine", readers=0):
+        """Replay a scenario; with ``readers``, under that many polling reader threads."""
+        if not readers:
+            return self._run(scenario, path)
+        with Readers(readers, self.users[0]) as polling:
+            result = self._run(scenario, path)
+        return dict(result, **polling.summary())
+
+    def _run(self, scenario, path):
+        from rest_framework.authtoken.models import Token
+        from rest_framework.test import APIClient
+
+        client = APIClient() if path == "api" else None
+        tokens = {}
+        latencies, queries = [], []
+        for prepare, order, cancel in self.flow(scenario):
+            if prepare is not None:
+                prepare()
+            counter = QueryCounter()
+            if path == "api":
+                # Real token auth, so its lookup is part of the measured path.
+                if order.user_id not in tokens:
+                    tokens[order.user_id] = Token.objects.get_or_create(user=order.user)[0].key
+                client.credentials(HTTP_AUTHORIZATION=f"Token {tokens[order.user_id]}")
+                body = {
+                    "stock": order.stock_id, "order_type": order.order_type,
+                    "price": str(order.price), "quantity": order.quantity,
+                }
+                with connection.execute_wrapper(counter):
+                    start = time.perf_counter()
+                    if cancel:
+                        client.delete(f"/api/orders/{order.id}/")
+                    else:
+                        client.post("/api/orders/", body, format="json")
+                    elapsed = time.perf_counter() - start
+            else:
+                if not cancel:
+                    order.save()
+                with connection.execute_wrapper(counter):
+                    start = time.perf_counter()
+                    if cancel:
+                        cancel_order(order)
+                    else:
+                        match_orders(order)
+                    elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            queries.append(counter.count)
+        return summarize(scenario, path, latencies, queries)
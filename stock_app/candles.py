@@ -0,0 +1,109 @@
+"""
+Streaming OHLCV aggregation.
+
+Each trade is folded into the open bucket of every interval. When a trade
+lands in a later bucket the previous one is finished and returned for
+persisting, so the Candle table only ever receives complete bars and
+nothing has to GROUP BY over Trade. Open buckets live in memory and are
+merged into /api/stocks/<id>/candles/ responses; the ones a stopped
+process or a discarded book left open are finished by ``resume``.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+
+from .models import Candle, Trade
+
+INTERVAL_SECONDS = {"1s": 1, "1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+
+
+def bucket_start(when, interval):
+    """Start of the bucket containing ``when``, aligned to local (TIME_ZONE) midnight."""
+    local = timezone.localtime(when)
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    elapsed = int((local - midnight).total_seconds())
+    size = INTERVAL_SECONDS[interval]
+    return midnight + timedelta(seconds=elapsed - elapsed % size)
+
+
+def fold(candle, price, quantity):
+    candle.high = max(candle.high, price)
+    candle.low = min(candle.low, price)
+    candle.close = price
+    candle.volume += quantity
+
+
+def new_candle(stock_id, interval, start, price, quantity):
+    return Candle(
+        stock_id=stock_id, interval=interval, start=start,
+        open=price, high=price, low=price, close=price, volume=quantity,
+    )
+
+
+class CandleAggregator:
+    """The open bucket of every interval for one stock."""
+
+    def __init__(self, stock_id, current=None):
+        self.stock_id = stock_id
+        self.current = current or {}
+
+    @classmethod
+    def resume(cls, stock_id, now=None):
+        """
+        Rebuild each interval's last bucket from trades already in the table.
+        The bucket containing ``now`` stays open, so a restarted process keeps
+        extending it instead of overwriting it; an earlier one was still open
+        when the last process stopped (or the book was discarded) and is
+        written out as finished.
+        """
+        now = now or timezone.now()
+        latest = (
+            Trade.objects.filter(stock_id=stock_id)
+            .order_by("-timestamp", "-id").values_list("timestamp", flat=True).first()
+        )
+        current = {}
+        if latest is None:
+            return cls(stock_id, current)
+        finished = []
+        for interval in INTERVAL_SECONDS:
+            start = bucket_start(latest, interval)
+            trades = Trade.objects.filter(stock_id=stock_id, timestamp__gte=start)
+            summary = trades.aggregate(high=Max("price"), low=Min("price"), volume=Sum("quantity"))
+            first = trades.order_by("timestamp", "id").values_list("price", flat=True).first()
+            last = trades.order_by("-timestamp", "-id").values_list("price", flat=True).first()
+            candle = new_candle(stock_id, interval, start, first, summary["volume"])
+            candle.high, candle.low, candle.close = summary["high"], summary["low"], last
+            if start == bucket_start(now, interval):
+                current[interval] = candle
+            else:
+                finished.append(candle)
+        save_candles(finished)
+        return cls(stock_id, current)
+
+    def add_trade(self, price, quantity, when):
+        """Fold one trade in; returns the candles it finished."""
+        price = Decimal(price)
+        finished = []
+        for interval in INTERVAL_SECONDS:
+            start = bucket_start(when, interval)
+            candle = self.current.get(interval)
+            if candle is not None and candle.start == start:
+                fold(candle, price, quantity)
+                continue
+            if candle is not None:
+                finished.append(candle)
+            self.current[interval] = new_candle(self.stock_id, interval, start, price, quantity)
+        return finished
+
+
+def save_candles(candles):
+    """Insert or overwrite candles keyed by (stock, interval, start)."""
+    if candles:
+        Candle.objects.bulk_create(
+            candles,
+            update_conflicts=True,
+            unique_fields=["stock", "interval", "start"],
+            update_fields=["open", "high", "low", "close", "volume"],
+        )
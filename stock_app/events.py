@@ -0,0 +1,92 @@
+"""
+In-process publish/subscribe for live trading events.
+
+The matcher publishes fills and order status changes on each user's topic
+and trades and book updates on each stock's topic. Subscribers are asyncio
+queues owned by streaming connections (see ``async_views``), so an idle
+connection costs one coroutine and one queue. Publishing is thread-safe:
+events are handed to each subscriber's event loop, and a subscriber that
+falls too far behind is dropped rather than buffered without bound.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+
+
+def user_topic(user_id):
+    return ("user", user_id)
+
+
+def stock_topic(stock_id):
+    return ("stock", stock_id)
+
+
+class Subscription:
+    def __init__(self, broker, topics, loop, maxsize):
+        self.broker = broker
+        self.topics = topics
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+
+    def _deliver(self, event):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too slow to keep up: end the stream so the client reconnects.
+            self.closed = True
+            self.broker.unsubscribe(self)
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self, timeout=None):
+        """Next event, None once the subscription is closed; raises TimeoutError when idle."""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.closed = True
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = {}
+
+    def subscribe(self, topics, maxsize=None):
+        """Subscribe the running event loop to ``topics``."""
+        if maxsize is None:
+            maxsize = getattr(settings, "EVENT_QUEUE_SIZE", 1000)
+        subscription = Subscription(self, tuple(topics), asyncio.get_running_loop(), maxsize)
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+
+    def has_subscribers(self, topic):
+        return topic in self._topics
+
+    def publish(self, topic, event):
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, event)
+            except RuntimeError:
+                # The subscriber's loop has shut down.
+                self.unsubscribe(subscription)
+
+
+broker = Broker()
@@ -0,0 +1,85 @@
+"""
+Timer-driven expiry of good-till-date orders.
+
+Resting GTD orders are kept in a heap keyed by ``expires_at``. One thread
+sleeps until the earliest expiry and then hands each due order to the
+matching sequencer as an ``expire_order`` action, so expiry is applied in
+order with the stock's other order flow and nothing scans the Order table.
+The matcher also skips (and expires) a due order it meets at the top of
+the book, so an order never trades after its expiry even if the sweeper
+is a little late.
+"""
+import functools
+import heapq
+import logging
+import threading
+
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    def __init__(self):
+        self._heap = []
+        self._scheduled = set()
+        self._wakeup = threading.Condition()
+        self._thread = None
+
+    def schedule(self, order):
+        """Expire ``order`` (resting, with ``expires_at``) when its time comes."""
+        with self._wakeup:
+            if order.id in self._scheduled:
+                return
+            self._scheduled.add(order.id)
+            heapq.heappush(self._heap, (order.expires_at, order.id, order.stock_id))
+            if self._heap[0][1] == order.id:
+                self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="order-expiry", daemon=True)
+                self._thread.start()
+
+    def pop_due(self, now):
+        """Unschedule and return ``(order_id, stock_id)`` for every order due by ``now``."""
+        due = []
+        with self._wakeup:
+            while self._heap and self._heap[0][0] <= now:
+                _, order_id, stock_id = heapq.heappop(self._heap)
+                self._scheduled.discard(order_id)
+                due.append((order_id, stock_id))
+        return due
+
+    def run_due(self, now=None):
+        """Expire every order due by ``now``; returns the futures of the expire actions."""
+        from .models import Order
+        from .sequencer import submit_order
+        from .services import expire_order
+
+        now = now or timezone.now()
+        return [
+            submit_order(Order(id=order_id, stock_id=stock_id), functools.partial(expire_order, now=now))
+            for order_id, stock_id in self.pop_due(now)
+        ]
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                if self._heap:
+                    delay = (self._heap[0][0] - timezone.now()).total_seconds()
+                else:
+                    delay = None
+                if delay is None or delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception("Order expiry sweep failed")
+
+    def clear(self):
+        with self._wakeup:
+            self._heap.clear()
+            self._scheduled.clear()
+
+
+sweeper = ExpirySweeper()
@@ -0,0 +1,68 @@
+"""
+Change counters for validating cached results.
+
+Each key (e.g. ``("user", 7)`` or ``("stock", 3)``) records when the data
+behind it last changed, as a tick of one process-wide clock. A cached
+result remembers the clock reading taken before it was computed and stays
+valid while none of its keys has changed since, so nothing ever has to
+find and delete the entries a change affects.
+
+Changes are recorded with ``data_changed`` once they commit. The clock is
+per process, like the order books, so this relies on the app running as
+the single process that also matches orders.
+"""
+import threading
+
+from django.db import transaction
+
+
+class Generations:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._changed = {}
+
+    def now(self):
+        """The current clock reading; take it before reading the data."""
+        return self._clock
+
+    def changed_at(self, key):
+        return self._changed.get(key, 0)
+
+    def bump(self, keys):
+        """Record that the data behind ``keys`` has changed."""
+        with self._lock:
+            self._clock += 1
+            for key in keys:
+                self._changed[key] = self._clock
+
+    def unchanged_since(self, stamp, keys):
+        changed = self._changed
+        return all(changed.get(key, 0) <= stamp for key in keys)
+
+
+generations = Generations()
+
+
+def user_key(user_id):
+    return ("user", user_id)
+
+
+def stock_key(stock_id):
+    return ("stock", stock_id)
+
+
+# Every stock at once, for the stock list.
+STOCK_LIST = ("stocks",)
+
+
+def data_changed(user_ids=(), stock_ids=()):
+    """
+    Record, once the current transaction commits, that these users' orders
+    and holdings or these stocks have changed.
+    """
+    keys = [user_key(user_id) for user_id in user_ids] + [stock_key(stock_id) for stock_id in stock_ids]
+    if stock_ids:
+        keys.append(STOCK_LIST)
+    if keys:
+        transaction.on_commit(lambda: generations.bump(keys))
@@ -0,0 +1,190 @@
+"""
+Lightweight hot-path instrumentation.
+
+``span(name)`` measures wall time, database query count and database time
+for a block of code; ``InstrumentationMiddleware`` does the same for every
+request, labelled by URL route. Totals and a latency histogram per span are
+kept in process and exposed in the Prometheus text format by
+``metrics_view``.
+
+Everything is off unless ``INSTRUMENTATION_ENABLED`` is set; a disabled
+span is a flag check returning a shared no-op context manager.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_enabled = getattr(settings, "INSTRUMENTATION_ENABLED", False)
+_noop = nullcontext()
+
+
+@receiver(setting_changed)
+def _refresh_enabled(setting, value, **kwargs):
+    global _enabled
+    if setting == "INSTRUMENTATION_ENABLED":
+        _enabled = bool(value)
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Series:
+    __slots__ = ("count", "seconds", "queries", "db_seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def record(self, labels, seconds, queries, db_seconds):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _Series()
+            series.count += 1
+            series.seconds += seconds
+            series.queries += queries
+            series.db_seconds += db_seconds
+            series.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def get(self, labels):
+        return self._series.get(labels)
+
+    def render(self):
+        """Prometheus text exposition of every recorded series."""
+        lines = [
+            "# HELP stock_span_seconds Wall time of instrumented spans.",
+            "# TYPE stock_span_seconds histogram",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for labels, s in series:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                cumulative = 0
+                for bound, hits in zip(BUCKETS + ("+Inf",), s.buckets):
+                    cumulative += hits
+                    lines.append(f'stock_span_seconds_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f"stock_span_seconds_sum{{{label_text}}} {s.seconds:.6f}")
+                lines.append(f"stock_span_seconds_count{{{label_text}}} {s.count}")
+            lines.append("# HELP stock_span_db_queries_total Database queries run inside spans.")
+            lines.append("# TYPE stock_span_db_queries_total counter")
+            for labels, s in series:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"stock_span_db_queries_total{{{label_text}}} {s.queries}")
+            lines.append("# HELP stock_span_db_seconds_total Database time spent inside spans.")
+            lines.append("# TYPE stock_span_db_seconds_total counter")
+            for labels, s in series:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"stock_span_db_seconds_total{{{label_text}}} {s.db_seconds:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _DbTimer:
+    """execute_wrapper that counts queries and their time."""
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def _measure(labels):
+    db = _DbTimer()
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(db):
+            yield
+    finally:
+        registry.record(labels, time.perf_counter() - start, db.queries, db.seconds)
+
+
+def span(name):
+    """Measure a block as the span ``name`` (a no-op when disabled)."""
+    if not _enabled:
+        return _noop
+    return _measure((("span", name),))
+
+
+class InstrumentationMiddleware:
+    """
+    Records every request as the ``request`` span, labelled by route.
+
+    Runs natively under ASGI too, so it doesn't push the async views onto a
+    thread; there only wall time is recorded, as their queries run on
+    other threads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not _enabled:
+            return self.get_response(request)
+        db = _DbTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(db):
+            response = self.get_response(request)
+        _record_request(request, time.perf_counter() - start, db.queries, db.seconds)
+        return response
+
+    async def __acall__(self, request):
+        if not _enabled:
+            return await self.get_response(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        _record_request(request, time.perf_counter() - start, 0, 0.0)
+        return response
+
+
+def _record_request(request, seconds, queries, db_seconds):
+    match = getattr(request, "resolver_match", None)
+    route = match.route if match else "unmatched"
+    registry.record((("span", "request"), ("route", route)), seconds, queries, db_seconds)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; only served while instrumentation is on."""
+    if not _enabled:
+        raise Http404
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
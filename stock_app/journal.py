@@ -0,0 +1,319 @@
+"""
+Append-only journal of matching events, with book snapshots for fast restart.
+
+Every matching pass appends one line: the order as it entered the book and
+the fills it produced; cancels and in-place amendments get a line each. A
+torn write at the end of the file loses at most that event. Lines are
+handed to the OS as they are written and fsynced in batches by a
+background thread every ``FSYNC_INTERVAL`` seconds, so the matcher never
+waits on the disk.
+
+This is a recovery log for the books, not a write-ahead log: a pass is
+appended after its settlement has committed, and the Order, Trade, User
+and UserHolding rows are still written synchronously inside the pass.
+Its only use is a restart that doesn't rebuild every book from the Order
+table; with ``DIR`` unset (the default) nothing is journalled at all.
+
+Every ``SNAPSHOT_EVERY`` lines the same thread writes a compact snapshot of
+each book and drops the journal segments it covers. On start-up the books
+are rebuilt from the latest snapshot plus the journal tail. The database
+remains the record of every order, so a recovered book is only used when
+its open quantity matches the database; any book that disagrees (e.g.
+because the journal tail was lost in an OS crash) is loaded from the
+Order table as before.
+
+Configured by the ``MATCHING_JOURNAL`` setting::
+
+    MATCHING_JOURNAL = {
+        "DIR": None,             # directory for segments and snapshots; None disables
+        "FSYNC_INTERVAL": 0.05,  # seconds between group fsyncs
+        "SNAPSHOT_EVERY": 10000, # journal lines between snapshots
+    }
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Count, Max, Sum
+from django.dispatch import receiver
+
+from .models import Order
+from .orderbook import _IS_OPEN, BookOrder, OrderBook, all_books, from_ticks, restore_books, to_ticks
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {"DIR": None, "FSYNC_INTERVAL": 0.05, "SNAPSHOT_EVERY": 10000}
+
+SNAPSHOT_FILE = "snapshot.json"
+
+
+def _config():
+    return {**DEFAULTS, **getattr(settings, "MATCHING_JOURNAL", {})}
+
+
+def _segment_name(number):
+    return f"journal-{number:06d}.log"
+
+
+def encode_order(order):
+    """Compact row for an order entering the book."""
+    return [
+        order.id, order.user_id, order.order_type, None if order.price is None else str(order.price), order.quantity,
+        order.remaining_quantity, order.status, order.timestamp.isoformat(),
+        order.expires_at.isoformat() if order.expires_at else None,
+    ]
+
+
+def decode_order(stock_id, row):
+    """The book record for an encoded order."""
+    order_id, user_id, side, price, quantity, remaining, status, timestamp, *rest = row
+    expires_at = datetime.fromisoformat(rest[0]) if rest and rest[0] else None
+    return BookOrder(
+        order_id, user_id, stock_id, side, to_ticks(price), quantity, remaining, status,
+        datetime.fromisoformat(timestamp), expires_at,
+    )
+
+
+class Journal:
+    def __init__(self, directory, fsync_interval, snapshot_every):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.seq = 0
+        self._since_snapshot = 0
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        # Each process writes to a fresh segment, so a torn line can only be
+        # the last one of a segment.
+        self._segment = max(self._segments(), default=0) + 1
+        self._file = open(self._path(_segment_name(self._segment)), "a", encoding="utf-8")
+        self._flusher = threading.Thread(target=self._run, name="matching-journal", daemon=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        return sorted(
+            int(name[8:14]) for name in os.listdir(self.directory)
+            if name.startswith("journal-") and name.endswith(".log")
+        )
+
+    def start(self):
+        self._flusher.start()
+
+    def append(self, event):
+        """Write one event line; returns its sequence number."""
+        with self._lock:
+            self.seq += 1
+            event["seq"] = self.seq
+            self._file.write(json.dumps(event, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self._dirty = True
+            self._since_snapshot += 1
+            return self.seq
+
+    def record_pass(self, stock_id, entry, fills, rests=True, expired=()):
+        """
+        Journal a matching pass: ``entry`` is the encoded incoming order,
+        ``rests`` whether its remainder stays in the book (not IOC/FOK/market)
+        and ``expired`` the due GTD orders the pass took out of the book.
+        Fill prices are in ticks.
+        """
+        return self.append({
+            "type": "order",
+            "stock": stock_id,
+            "order": entry,
+            "rests": rests,
+            "expired": [order.id for order in expired],
+            "fills": [[buy.id, sell.id, qty, str(from_ticks(price))] for buy, sell, qty, price in fills],
+        })
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            os.fsync(self._file.fileno())
+
+    def _run(self):
+        while not self._stopped.wait(self.fsync_interval):
+            try:
+                self.sync()
+                if self._since_snapshot >= self.snapshot_every:
+                    self.snapshot()
+            except Exception:
+                logger.exception("Matching journal flush failed")
+
+    def stop(self):
+        self._stopped.set()
+        if self._flusher.is_alive():
+            self._flusher.join()
+        self.sync()
+        self._file.close()
+
+    def _rotate(self):
+        with self._lock:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._segment += 1
+            self._file = open(self._path(_segment_name(self._segment)), "a", encoding="utf-8")
+            self._dirty = False
+            self._since_snapshot = 0
+            return self._segment
+
+    def snapshot(self):
+        """
+        Write every book's resting orders and drop the segments before it.
+
+        The journal moves to a new segment first; each book is then copied
+        under its own lock along with the sequence number it is current to,
+        so replay skips exactly the events already in the copy.
+        """
+        segment = self._rotate()
+        books = {}
+        for book in all_books():
+            with book.lock:
+                books[str(book.stock_id)] = {
+                    "seq": self.seq,
+                    "loaded_up_to": book.loaded_up_to,
+                    "orders": [encode_order(order) for order in book.orders()],
+                }
+        path = self._path(SNAPSHOT_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "books": books}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        for number in self._segments():
+            if number < segment:
+                os.remove(self._path(_segment_name(number)))
+
+    def replay(self):
+        """Rebuild books from the snapshot and the journal after it."""
+        books, seqs, first_segment = {}, {}, 1
+        path = self._path(SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            first_segment = snapshot["segment"]
+            for stock_id, state in snapshot["books"].items():
+                stock_id = int(stock_id)
+                book = books[stock_id] = OrderBook(stock_id)
+                book.loaded_up_to = state["loaded_up_to"]
+                seqs[stock_id] = state["seq"]
+                self.seq = max(self.seq, state["seq"])
+                for row in state["orders"]:
+                    book.add(decode_order(stock_id, row))
+
+        for number in self._segments():
+            if number < first_segment:
+                continue
+            with open(self._path(_segment_name(number)), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break  # torn final write
+                    self.seq = max(self.seq, event["seq"])
+                    stock_id = event["stock"]
+                    if event["seq"] <= seqs.get(stock_id, 0):
+                        continue
+                    book = books.get(stock_id)
+                    if book is None:
+                        book = books[stock_id] = OrderBook(stock_id)
+                    _apply(book, event)
+        return books
+
+    def recover(self):
+        """Replay the journal and hand over the books that agree with the database."""
+        books = self.replay()
+        if not books:
+            return []
+        totals = {
+            row["stock_id"]: row
+            for row in Order.objects.filter(_IS_OPEN, stock_id__in=books)
+            .exclude(kind=Order.MARKET)
+            .values("stock_id")
+            .annotate(count=Count("id"), remaining=Sum("remaining_quantity"), last=Max("id"))
+        }
+        recovered = []
+        for stock_id, book in books.items():
+            expected = totals.get(stock_id, {"count": 0, "remaining": None, "last": 0})
+            resting = list(book.orders())
+            remaining = sum(order.remaining_quantity for order in resting) if resting else None
+            if (len(resting), remaining) != (expected["count"], expected["remaining"]):
+                logger.warning("Journal disagrees with the database for stock %s; reloading it", stock_id)
+                continue
+            book.loaded_up_to = max(book.loaded_up_to, expected["last"] or 0)
+            recovered.append(book)
+        restore_books(recovered)
+        return recovered
+
+
+def _apply(book, event):
+    if event["type"] in ("cancel", "expire"):
+        book.remove(event["order"])
+        return
+    if event["type"] == "amend":
+        if event["order"] in book:
+            order = book.reduce(event["order"], event["cut"])
+            order.quantity -= event["cut"]
+        return
+    if event["type"] != "order":
+        raise ValueError(f"Unknown journal event {event['type']!r}")
+    # The incoming order goes to the back of its level before its fills are
+    # applied: it only ever rests behind the orders already there. Orders
+    # that never rest only take from the others.
+    order_id = event["order"][0]
+    book.remove(order_id)
+    book.loaded_up_to = max(book.loaded_up_to, order_id)
+    if event.get("rests", True):
+        book.add(decode_order(book.stock_id, event["order"]))
+    for expired_id in event.get("expired", ()):
+        book.remove(expired_id)
+    for buy_id, sell_id, qty, price in event["fills"]:
+        for order_id in (buy_id, sell_id):
+            if order_id in book:
+                filled = book.reduce(order_id, qty)
+                filled.status = Order.COMPLETED if filled.remaining_quantity == 0 else Order.PARTIAL
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """The process's matching journal, recovering books on first use; None when disabled."""
+    global _journal
+    if _journal is not None:
+        return _journal
+    config = _config()
+    if not config["DIR"]:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            journal = Journal(config["DIR"], config["FSYNC_INTERVAL"], config["SNAPSHOT_EVERY"])
+            journal.recover()
+            journal.start()
+            _journal = journal
+    return _journal
+
+
+def reset_journal():
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            _journal.stop()
+            _journal = None
+
+
+@receiver(setting_changed)
+def _refresh_journal(setting, **kwargs):
+    if setting == "MATCHING_JOURNAL":
+        reset_journal()
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from stock_app.candles import CandleAggregator, save_candles
+from stock_app.models import Stock, Trade
+
+
+class Command(BaseCommand):
+    help = "Rebuild OHLCV candles from the Trade table, reading trades in fixed-size chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stock", type=int, action="append", dest="stocks",
+                            help="Only backfill this stock id (repeatable).")
+        parser.add_argument("--chunk-size", type=int, default=5000,
+                            help="Trades read per query (default 5000).")
+
+    def handle(self, *args, stocks=None, chunk_size=5000, **options):
+        stock_ids = stocks or list(Stock.objects.order_by("id").values_list("id", flat=True))
+        for stock_id in stock_ids:
+            trades, candles = self.backfill(stock_id, chunk_size)
+            self.stdout.write(f"stock {stock_id}: {trades} trades -> {candles} candles")
+
+    def backfill(self, stock_id, chunk_size):
+        """
+        Walk one stock's trades in (timestamp, id) order with a keyset
+        cursor. Only the open bucket of each interval and one chunk of
+        finished candles are held in memory at a time.
+        """
+        aggregator = CandleAggregator(stock_id)
+        trades_seen = candles_written = 0
+        cursor = None
+        while True:
+            chunk = Trade.objects.filter(stock_id=stock_id)
+            if cursor is not None:
+                timestamp, pk = cursor
+                chunk = chunk.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+            chunk = list(
+                chunk.order_by("timestamp", "id").values_list("id", "timestamp", "price", "quantity")[:chunk_size]
+            )
+            if not chunk:
+                break
+            finished = []
+            for pk, timestamp, price, quantity in chunk:
+                finished.extend(aggregator.add_trade(price, quantity, timestamp))
+            save_candles(finished)
+            candles_written += len(finished)
+            trades_seen += len(chunk)
+            cursor = (chunk[-1][1], chunk[-1][0])
+
+        open_candles = list(aggregator.current.values())
+        save_candles(open_candles)
+        return trades_seen, candles_written + len(open_candles)
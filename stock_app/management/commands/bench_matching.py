@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from stock_app.benchmark import SCENARIOS, Benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the matching engine on synthetic order flows. Runs against a "
+        "throw-away test database and reports orders/sec, latency percentiles "
+        "and queries per order; with --readers, also the throughput and latency "
+        "of concurrent GET /api/stocks/ requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--stocks", type=int, default=5)
+        parser.add_argument("--resting", type=int, default=1000, help="Resting orders seeded before the run.")
+        parser.add_argument("--orders", type=int, default=500, help="Orders replayed per scenario.")
+        parser.add_argument("--sweep-depth", type=int, default=50, help="Resting orders taken by each sweep.")
+        parser.add_argument("--scenario", choices=SCENARIOS, action="append", dest="scenarios",
+                            help="Scenario to run (repeatable, default: all).")
+        parser.add_argument("--path", choices=("engine", "api"), default="engine",
+                            help="Call match_orders directly or go through POST /api/orders/.")
+        parser.add_argument("--readers", type=int, default=0,
+                            help="Reader threads polling GET /api/stocks/ during each scenario.")
+        parser.add_argument("--sqlite-defaults", action="store_true",
+                            help="Ignore SQLITE_PRAGMAS and SQLITE_WAL_PRAGMAS (rollback journal), "
+                                 "to compare against them.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--json", action="store_true", help="Print one JSON object per scenario.")
+
+    def handle(self, *args, **options):
+        with ExitStack() as stack:
+            if options["sqlite_defaults"]:
+                stack.enter_context(override_settings(SQLITE_PRAGMAS={}))
+            else:
+                # Only the throw-away test database is switched to WAL.
+                pragmas = {**settings.SQLITE_PRAGMAS, **settings.SQLITE_WAL_PRAGMAS}
+                stack.enter_context(override_settings(SQLITE_PRAGMAS=pragmas))
+            if options["readers"] and connection.vendor == "sqlite":
+                # Readers need their own connections to a real file: an
+                # in-memory test database has no journal to compare.
+                directory = stack.enter_context(tempfile.TemporaryDirectory())
+                test_settings = connection.settings_dict.setdefault("TEST", {})
+                stack.enter_context(override_test_name(test_settings, os.path.join(directory, "bench.sqlite3")))
+            results = self.run_scenarios(options)
+        self.report(results, options)
+
+    def run_scenarios(self, options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = []
+            for scenario in options["scenarios"] or SCENARIOS:
+                call_command("flush", verbosity=0, interactive=False)
+                bench = Benchmark(
+                    users=options["users"], stocks=options["stocks"], resting=options["resting"],
+                    orders=options["orders"], sweep_depth=options["sweep_depth"], seed=options["seed"],
+                )
+                bench.seed()
+                # Match inline so the queries of the whole request are counted
+                # on this thread's connection.
+                with override_settings(MATCHING_SHARDS=0):
+                    results.append(bench.run(scenario, options["path"], options["readers"]))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        return results
+
+    def report(self, results, options):
+        if options["json"]:
+            for result in results:
+                self.stdout.write(json.dumps(result))
+            return
+        readers = options["readers"]
+        self.stdout.write(
+            f"{'scenario':<14}{'path':<8}{'orders':>8}{'orders/s':>11}"
+            f"{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}{'queries':>9}"
+            + (f"{'reads/s':>10}{'read p50':>10}{'read p99':>10}" if readers else "")
+        )
+        for r in results:
+            self.stdout.write(
+                f"{r['scenario']:<14}{r['path']:<8}{r['orders']:>8}{r['orders_per_sec']:>11.1f}"
+                f"{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['p999_ms']:>9.2f}{r['queries_per_order']:>9.1f}"
+                + (f"{r['reads_per_sec']:>10.1f}{r['read_p50_ms']:>10.2f}{r['read_p99_ms']:>10.2f}" if readers else "")
+            )
+
+
+class override_test_name:
+    """Point the test database at ``name`` for the duration."""
+
+    def __init__(self, test_settings, name):
+        self.test_settings = test_settings
+        self.name = name
+
+    def __enter__(self):
+        self.old = self.test_settings.get("NAME")
+        self.test_settings["NAME"] = self.name
+
+    def __exit__(self, *exc):
+        self.test_settings["NAME"] = self.old
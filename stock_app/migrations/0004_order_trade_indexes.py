@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_app', '0003_alter_stock_current_price_alter_stock_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stock',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-timestamp'], name='order_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status__in', ['PENDING', 'PARTIAL'])), fields=['stock', 'timestamp', 'id'], name='order_open_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['stock', 'timestamp'], name='trade_stock_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_trade_users(apps, schema_editor):
+    Order = apps.get_model("stock_app", "Order")
+    Trade = apps.get_model("stock_app", "Trade")
+    Trade.objects.update(
+        buyer_id=Subquery(Order.objects.filter(pk=OuterRef("buy_order_id")).values("user_id")[:1]),
+        seller_id=Subquery(Order.objects.filter(pk=OuterRef("sell_order_id")).values("user_id")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_app', '0004_order_trade_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trade',
+            name='buyer',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='seller',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sales', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_trade_users, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='trade',
+            name='buyer',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='purchases', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='trade',
+            name='seller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sales', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['buyer', '-timestamp'], name='trade_buyer_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['seller', '-timestamp'], name='trade_seller_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_app', '0006_stock_session_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.CharField(choices=[('1s', '1 second'), ('1m', '1 minute'), ('5m', '5 minutes'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('start', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('high', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('low', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('close', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('volume', models.PositiveBigIntegerField()),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stock_app.stock')),
+            ],
+            options={
+                'unique_together': {('stock', 'interval', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_app', '0008_order_cancelled_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='kind',
+            field=models.CharField(choices=[('LIMIT', 'Limit'), ('MARKET', 'Market')], default='LIMIT', max_length=6),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='time_in_force',
+            field=models.CharField(choices=[('GTC', 'Good till cancelled'), ('IOC', 'Immediate or cancel'), ('FOK', 'Fill or kill'), ('GTD', 'Good till date')], default='GTC', max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PARTIAL', 'Partial'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled'), ('EXPIRED', 'Expired')], default='PENDING', max_length=10),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:20
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_app', '0009_order_kind_time_in_force'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userholding',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15),
+        ),
+    ]
@@ -20,6 +20,12 @@ class Stock(models.Model):
     name = models.CharField(max_length=100, db_index=True)
     current_price = models.DecimalField(max_digits=10, decimal_places=2)
     timestamp = models.DateTimeField(auto_now=True)
+    # Trading session aggregates, maintained by the matching engine.
+    session_date = models.DateField(null=True, blank=True)
+    session_high = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    session_low = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    session_volume = models.PositiveBigIntegerField(default=0)
+    vwap = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True)
     def get_identifier(self):
       
         if hasattr(self, 'symbol'):
@@ -39,28 +45,87 @@ class Order(models.Model):
     PENDING = "PENDING"
     PARTIAL = "PARTIAL"
     COMPLETED = "COMPLETED"
-    STATUS_CHOICES = [(PENDING, "Pending"), (PARTIAL, "Partial"), (COMPLETED, "Completed")]
+    CANCELLED = "CANCELLED"
+    EXPIRED = "EXPIRED"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"), (PARTIAL, "Partial"), (COMPLETED, "Completed"), (CANCELLED, "Cancelled"),
+        (EXPIRED, "Expired"),
+    ]
+
+    LIMIT = "LIMIT"
+    MARKET = "MARKET"
+    KINDS = [(LIMIT, "Limit"), (MARKET, "Market")]
+
+    # Time in force: good till cancelled, immediate or cancel, fill or kill,
+    # good till date (expires_at).
+    GTC = "GTC"
+    IOC = "IOC"
+    FOK = "FOK"
+    GTD = "GTD"
+    TIME_IN_FORCE_CHOICES = [
+        (GTC, "Good till cancelled"), (IOC, "Immediate or cancel"), (FOK, "Fill or kill"), (GTD, "Good till date"),
+    ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
     order_type = models.CharField(max_length=4, choices=ORDER_TYPES)
-    price = models.DecimalField(max_digits=12, decimal_places=2)
+    kind = models.CharField(max_length=6, choices=KINDS, default=LIMIT)
+    time_in_force = models.CharField(max_length=3, choices=TIME_IN_FORCE_CHOICES, default=GTC)
+    # Market orders have no limit price.
+    price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
     quantity = models.PositiveIntegerField()
     remaining_quantity = models.PositiveIntegerField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
     timestamp = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def rests(self):
+        """Whether an unfilled remainder stays in the book (otherwise it is cancelled)."""
+        return self.kind == self.LIMIT and self.time_in_force in (self.GTC, self.GTD)
+
+    class Meta:
+        indexes = [
+            # Order history: OrderListCreateView and the Trade -> Order join in TradeListView.
+            models.Index(fields=["user", "-timestamp"], name="order_user_ts_idx"),
+            # Book rebuild: only resting orders, in time priority.
+            models.Index(
+                fields=["stock", "timestamp", "id"],
+                name="order_open_book_idx",
+                condition=models.Q(status__in=["PENDING", "PARTIAL"]),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.order_type} {self.quantity} {self.stock.name} @ {self.price} ({self.status})"
 
+class TradeQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """Trades where ``user`` was on either side, via the buyer/seller indexes."""
+        return self.filter(models.Q(buyer=user) | models.Q(seller=user))
+
+
 class Trade(models.Model):
     buy_order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="buy_trades")
     sell_order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="sell_trades")
+    # Copied from the orders at fill time so a user's ledger needs no join.
+    # Indexed together with timestamp in Meta.indexes.
+    buyer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="purchases", db_index=False)
+    seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sales", db_index=False)
     stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
     price = models.DecimalField(max_digits=12, decimal_places=2)
     quantity = models.PositiveIntegerField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = TradeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["stock", "timestamp"], name="trade_stock_ts_idx"),
+            models.Index(fields=["buyer", "-timestamp"], name="trade_buyer_ts_idx"),
+            models.Index(fields=["seller", "-timestamp"], name="trade_seller_ts_idx"),
+        ]
+
     def __str__(self):
         return f"Trade {self.id}: {self.quantity} {self.stock.name} @ {self.price}"
 
@@ -69,9 +134,31 @@ class UserHolding(models.Model):
     stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
     avg_price = models.DecimalField(max_digits=12, decimal_places=2)
+    # Profit or loss locked in by sales, against the average price paid.
+    realized_pnl = models.DecimalField(max_digits=15, decimal_places=2, default=Decimal("0.00"))
 
     class Meta:
         unique_together = ("user", "stock")
 
     def __str__(self):
         return f"{self.user.username} holding {self.quantity} {self.stock.name}"
+
+
+class Candle(models.Model):
+    """OHLCV bar for one stock over one interval bucket, built from trades."""
+    INTERVALS = [("1s", "1 second"), ("1m", "1 minute"), ("5m", "5 minutes"), ("1h", "1 hour"), ("1d", "1 day")]
+
+    stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
+    interval = models.CharField(max_length=2, choices=INTERVALS)
+    start = models.DateTimeField()
+    open = models.DecimalField(max_digits=12, decimal_places=2)
+    high = models.DecimalField(max_digits=12, decimal_places=2)
+    low = models.DecimalField(max_digits=12, decimal_places=2)
+    close = models.DecimalField(max_digits=12, decimal_places=2)
+    volume = models.PositiveBigIntegerField()
+
+    class Meta:
+        unique_together = ("stock", "interval", "start")
+
+    def __str__(self):
+        return f"{self.stock_id} {self.interval} {self.start:%Y-%m-%d %H:%M:%S}"
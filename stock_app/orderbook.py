@@ -0,0 +1,449 @@
+"""
+In-memory price-time priority order books, one per stock.
+
+The database stays the durable record of every order; the book only holds
+the resting (PENDING/PARTIAL) orders so matching never has to scan the
+Order table. Resting orders are kept as compact ``BookOrder`` records with
+integer prices in ticks (paise), converted to and from Decimal only where
+they meet the database and the API. A book is rebuilt the first time its stock is matched in a
+process, from the matching journal when one recovered it (see
+``journal``) and otherwise from the open orders, and is discarded (to be
+rebuilt from the database) if a matching pass fails halfway.
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .expiry import sweeper
+from .models import Order, Stock, Trade
+
+OPEN_STATUSES = (Order.PENDING, Order.PARTIAL)
+
+# Ticks per currency unit: prices have two decimal places.
+TICKS = 100
+
+
+def to_ticks(price):
+    """A Decimal price as integer ticks (None stays None)."""
+    return None if price is None else int(Decimal(price).scaleb(2))
+
+
+def from_ticks(ticks):
+    return Decimal(ticks).scaleb(-2)
+
+# The status test is spelled out as literals so the planner can match it to
+# the partial order_open_book_idx; SQLite won't use a partial index whose
+# condition is only satisfied through bound parameters.
+_IS_OPEN = RawSQL(
+    "\"stock_app_order\".\"status\" IN ('PENDING', 'PARTIAL')", [], output_field=BooleanField()
+)
+
+
+class BookOrder:
+    """
+    A resting order as the book holds it: the fields matching needs, with
+    the price in ticks, and no model machinery.
+    """
+
+    __slots__ = (
+        "id", "user_id", "stock_id", "order_type", "ticks", "quantity",
+        "remaining_quantity", "status", "timestamp", "expires_at",
+    )
+    # Order columns in constructor order, with price in place of ticks.
+    FIELDS = (
+        "id", "user_id", "stock_id", "order_type", "price", "quantity",
+        "remaining_quantity", "status", "timestamp", "expires_at",
+    )
+
+    def __init__(self, id, user_id, stock_id, order_type, ticks, quantity,
+                 remaining_quantity, status, timestamp, expires_at=None):
+        self.id = id
+        self.user_id = user_id
+        self.stock_id = stock_id
+        self.order_type = order_type
+        self.ticks = ticks
+        self.quantity = quantity
+        self.remaining_quantity = remaining_quantity
+        self.status = status
+        self.timestamp = timestamp
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_row(cls, row):
+        """From a ``values_list(*FIELDS)`` row."""
+        order_id, user_id, stock_id, side, price, *rest = row
+        return cls(order_id, user_id, stock_id, side, to_ticks(price), *rest)
+
+    @classmethod
+    def from_order(cls, order):
+        return cls(
+            order.id, order.user_id, order.stock_id, order.order_type, to_ticks(order.price),
+            order.quantity, order.remaining_quantity, order.status, order.timestamp, order.expires_at,
+        )
+
+    @property
+    def price(self):
+        return from_ticks(self.ticks)
+
+
+class PriceLevel(OrderedDict):
+    """
+    FIFO queue of the orders at one price, with their total remaining
+    quantity and how many of them are good till date.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.quantity = 0
+        self.dated = 0
+
+    def due_quantity(self, now):
+        """Remaining quantity of orders already past their expiry but not swept."""
+        if not self.dated:
+            return 0
+        return sum(
+            order.remaining_quantity for order in self.values()
+            if order.expires_at is not None and order.expires_at <= now
+        )
+
+
+class SessionStats:
+    """
+    Running last price, high/low, volume and VWAP for a stock's trading day.
+
+    Folded forward trade by trade in memory and written back to the Stock
+    row once per matching pass.
+    """
+
+    def __init__(self, stock):
+        self.last_price = stock.current_price
+        self.session_date = stock.session_date
+        self.high = stock.session_high
+        self.low = stock.session_low
+        self.volume = stock.session_volume
+        self.turnover = (stock.vwap or Decimal(0)) * stock.session_volume
+
+    def add_trade(self, price, quantity, when):
+        price = Decimal(price)
+        day = timezone.localdate(when)
+        if day != self.session_date:
+            self.session_date = day
+            self.high = self.low = None
+            self.volume = 0
+            self.turnover = Decimal(0)
+        self.last_price = price
+        self.high = price if self.high is None else max(self.high, price)
+        self.low = price if self.low is None else min(self.low, price)
+        self.volume += quantity
+        self.turnover += price * quantity
+
+    @property
+    def vwap(self):
+        if not self.volume:
+            return None
+        return (self.turnover / self.volume).quantize(Decimal("0.0001"))
+
+    def as_fields(self):
+        return {
+            "current_price": self.last_price,
+            "session_date": self.session_date,
+            "session_high": self.high,
+            "session_low": self.low,
+            "session_volume": self.volume,
+            "vwap": self.vwap,
+        }
+
+
+class OrderBook:
+    """
+    Sorted price levels with a FIFO queue per level.
+
+    Level keys are kept in ascending lists so the best price of each side
+    is always the last element: bids are keyed by price in ticks, asks by
+    negated ticks. Best bid/ask is O(1), adding a level or removing one is a
+    bisect, and each level is an OrderedDict so an order can be removed by
+    id without walking the queue.
+    """
+
+    def __init__(self, stock_id):
+        self.stock_id = stock_id
+        self.lock = threading.RLock()
+        self._keys = {Order.BUY: [], Order.SELL: []}
+        self._levels = {Order.BUY: {}, Order.SELL: {}}
+        self._orders = {}
+        # Highest order id picked up when the book was loaded from the table.
+        self.loaded_up_to = 0
+        self.last_trade = None
+        self.stats = None
+        self.candles = None
+
+    @staticmethod
+    def _key(side, price):
+        return price if side == Order.BUY else -price
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def get(self, order_id):
+        return self._orders.get(order_id)
+
+    def add(self, order):
+        """Rest an order (an Order or BookOrder) at the back of its price level; returns its record."""
+        if not isinstance(order, BookOrder):
+            order = BookOrder.from_order(order)
+        side = order.order_type
+        key = self._key(side, order.ticks)
+        levels = self._levels[side]
+        level = levels.get(key)
+        if level is None:
+            level = levels[key] = PriceLevel()
+            keys = self._keys[side]
+            keys.insert(bisect_left(keys, key), key)
+        level[order.id] = order
+        level.quantity += order.remaining_quantity
+        if order.expires_at is not None:
+            level.dated += 1
+        self._orders[order.id] = order
+        return order
+
+    def remove(self, order_id):
+        """Take an order out of the book. Returns it, or None if it was not resting."""
+        order = self._orders.pop(order_id, None)
+        if order is None:
+            return None
+        side = order.order_type
+        key = self._key(side, order.ticks)
+        level = self._levels[side][key]
+        del level[order_id]
+        level.quantity -= order.remaining_quantity
+        if order.expires_at is not None:
+            level.dated -= 1
+        if not level:
+            self._drop_level(side, key)
+        return order
+
+    def reduce(self, order_id, qty):
+        """
+        Take ``qty`` off a resting order without moving it in its queue,
+        removing it once nothing is left. Returns the order.
+        """
+        order = self._orders[order_id]
+        level = self._levels[order.order_type][self._key(order.order_type, order.ticks)]
+        if qty >= order.remaining_quantity:
+            self.remove(order_id)
+            order.remaining_quantity -= qty
+            return order
+        order.remaining_quantity -= qty
+        level.quantity -= qty
+        return order
+
+    def orders(self):
+        """Resting orders, bids then asks, each best price first in queue order."""
+        for side in (Order.BUY, Order.SELL):
+            levels = self._levels[side]
+            for key in reversed(self._keys[side]):
+                yield from levels[key].values()
+
+    def _drop_level(self, side, key):
+        del self._levels[side][key]
+        keys = self._keys[side]
+        if keys[-1] == key:
+            keys.pop()
+        else:
+            del keys[bisect_left(keys, key)]
+
+    def best_price(self, side):
+        keys = self._keys[side]
+        if not keys:
+            return None
+        return from_ticks(keys[-1] if side == Order.BUY else -keys[-1])
+
+    def best_bid(self):
+        return self.best_price(Order.BUY)
+
+    def best_ask(self):
+        return self.best_price(Order.SELL)
+
+    def best_order(self, side):
+        """The order at the front of the queue at the best price of ``side``."""
+        keys = self._keys[side]
+        if not keys:
+            return None
+        level = self._levels[side][keys[-1]]
+        return next(iter(level.values()))
+
+    def fill_best(self, side, qty):
+        """
+        Take ``qty`` from the order at the front of the best level of
+        ``side``, removing it from the book once it is fully filled.
+        """
+        keys = self._keys[side]
+        key = keys[-1]
+        level = self._levels[side][key]
+        order = next(iter(level.values()))
+        order.remaining_quantity -= qty
+        level.quantity -= qty
+        if order.remaining_quantity == 0:
+            del level[order.id]
+            del self._orders[order.id]
+            if order.expires_at is not None:
+                level.dated -= 1
+            if not level:
+                del self._levels[side][key]
+                keys.pop()
+        return order
+
+    def available(self, side, limit, qty, budget=None, now=None):
+        """
+        Whether ``side`` holds at least ``qty`` at prices reaching ``limit``
+        ticks (None for any price), costing at most ``budget`` ticks if given.
+        Walks price levels, not orders, and stops as soon as enough is found;
+        with ``now``, orders already due to expire are left out, walking
+        only the levels that hold good-till-date orders.
+        """
+        keys = self._keys[side]
+        book_side = self._levels[side]
+        total = 0
+        for key in reversed(keys):
+            price = key if side == Order.BUY else -key
+            if limit is not None and (price < limit if side == Order.BUY else price > limit):
+                break
+            level = book_side[key]
+            quantity = min(level.quantity, qty - total)
+            if now is not None:
+                quantity = min(quantity, level.quantity - level.due_quantity(now))
+            if budget is not None:
+                quantity = min(quantity, budget // price)
+                budget -= price * quantity
+            total += quantity
+            if total >= qty:
+                return True
+        return False
+
+    def depth(self, side, levels):
+        """``(price, quantity, order count)`` for the best ``levels`` prices of ``side``."""
+        keys = self._keys[side]
+        book_side = self._levels[side]
+        return [
+            (from_ticks(key if side == Order.BUY else -key), book_side[key].quantity, len(book_side[key]))
+            for key in keys[:-levels - 1:-1]
+        ]
+
+    def snapshot(self, levels):
+        """Best bid/ask, top ``levels`` of aggregated depth and the last trade."""
+        def side_depth(side):
+            return [
+                {"price": str(price), "quantity": quantity, "orders": count}
+                for price, quantity, count in self.depth(side, levels)
+            ]
+
+        best_bid, best_ask = self.best_bid(), self.best_ask()
+        last_trade = None
+        if self.last_trade is not None:
+            price, quantity, timestamp = self.last_trade
+            last_trade = {"price": str(price), "quantity": quantity, "timestamp": timestamp}
+        return {
+            "stock": self.stock_id,
+            "best_bid": None if best_bid is None else str(best_bid),
+            "best_ask": None if best_ask is None else str(best_ask),
+            "bids": side_depth(Order.BUY),
+            "asks": side_depth(Order.SELL),
+            "last_trade": last_trade,
+        }
+
+
+def crosses(side, limit, resting):
+    """Whether an incoming ``side`` order limited at ``limit`` ticks (None for market) reaches a resting order."""
+    if limit is None:
+        return True
+    if side == Order.BUY:
+        return resting.ticks <= limit
+    return resting.ticks >= limit
+
+
+def opposite_side(side):
+    return Order.SELL if side == Order.BUY else Order.BUY
+
+
+_books = {}
+_books_lock = threading.Lock()
+# Books rebuilt from the journal that haven't been matched against yet.
+_recovered = {}
+
+
+def open_orders(stock_id):
+    """
+    A stock's resting orders in time priority. A market order is open only
+    between being saved and being matched, and never rests.
+    """
+    return (
+        Order.objects.filter(_IS_OPEN, stock_id=stock_id)
+        .exclude(kind=Order.MARKET)
+        .order_by("timestamp", "id")
+    )
+
+
+def load_book(stock_id):
+    """Build a book from the journal's recovered state or the stock's open orders."""
+    book = _recovered.pop(stock_id, None)
+    if book is None:
+        book = OrderBook(stock_id)
+        for row in open_orders(stock_id).values_list(*BookOrder.FIELDS).iterator():
+            order = book.add(BookOrder.from_row(row))
+            book.loaded_up_to = max(book.loaded_up_to, order.id)
+    for order in book.orders():
+        if order.expires_at is not None:
+            sweeper.schedule(order)
+    stock = Stock.objects.filter(pk=stock_id).first()
+    if stock is not None:
+        book.stats = SessionStats(stock)
+    last = Trade.objects.filter(stock_id=stock_id).order_by("-timestamp", "-id").first()
+    if last is not None:
+        book.last_trade = (last.price, last.quantity, last.timestamp)
+    return book
+
+
+def get_book(stock_id):
+    """Return the process-wide book for a stock, loading it on first use."""
+    book = _books.get(stock_id)
+    if book is not None:
+        return book
+    with _books_lock:
+        book = _books.get(stock_id)
+        if book is None:
+            book = _books[stock_id] = load_book(stock_id)
+    return book
+
+
+def discard_book(stock_id):
+    """Forget a book so the next matching pass reloads it from the database."""
+    with _books_lock:
+        _books.pop(stock_id, None)
+
+
+def restore_books(books):
+    """Use journal-recovered books in place of loading from the database."""
+    with _books_lock:
+        for book in books:
+            if book.stock_id not in _books:
+                _recovered[book.stock_id] = book
+
+
+def all_books():
+    """Every book this process knows, loaded or only recovered so far."""
+    with _books_lock:
+        return list(_books.values()) + list(_recovered.values())
+
+
+def reset_books():
+    with _books_lock:
+        _books.clear()
+        _recovered.clear()
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class TimestampCursorPagination(CursorPagination):
+    """
+    Keyset pagination on (timestamp, id), newest first.
+
+    Each page is a range read from the cursor position, so deep pages cost
+    the same as the first one and no COUNT(*) is ever run. Clients can ask
+    for ``?page_size=`` up to ``max_page_size``.
+    """
+    ordering = ("-timestamp", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+
+class IdCursorPagination(TimestampCursorPagination):
+    """Keyset pagination for rows without a timestamp."""
+    ordering = ("-id",)
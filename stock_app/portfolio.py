@@ -0,0 +1,111 @@
+"""
+Portfolio valuation: market value, P&L and allocation of a user's holdings.
+
+One query reads every position joined with its stock's last price. The
+arithmetic then runs column by column over the whole portfolio (quantities
+times prices, values less costs) instead of through a model instance and
+serializer per row. Valuations are cached per user and stamped with the
+``generations`` clock: a settled fill bumps its users and stock, an edited
+holding its user and an edited stock itself (see ``data_changed``), so a
+cached valuation is served only while nothing it was computed from has
+changed.
+"""
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from operator import mul, sub
+
+from django.conf import settings
+from django.db.models import Q
+
+from .generations import generations, stock_key, user_key
+from .models import UserHolding
+
+CENT = Decimal("0.01")
+
+
+def _money(column):
+    return [str(value.quantize(CENT)) for value in column]
+
+
+def value_portfolio(user_id):
+    """Value a user's positions; closed ones are listed for their realized P&L."""
+    rows = list(
+        UserHolding.objects.filter(Q(quantity__gt=0) | ~Q(realized_pnl=0), user_id=user_id)
+        .order_by("stock_id")
+        .values_list("stock_id", "stock__name", "quantity", "avg_price", "stock__current_price", "realized_pnl")
+    )
+    if not rows:
+        zero = str(Decimal(0).quantize(CENT))
+        return {"holdings": [], "totals": {
+            "market_value": zero, "cost_basis": zero, "unrealized_pnl": zero, "realized_pnl": zero,
+        }}
+
+    stock_ids, names, quantities, avg_prices, prices, realized = zip(*rows)
+    cost = list(map(mul, quantities, avg_prices))
+    value = list(map(mul, quantities, prices))
+    unrealized = list(map(sub, value, cost))
+    total_value, total_cost = sum(value), sum(cost)
+    if total_value:
+        allocation = [str((v * 100 / total_value).quantize(CENT)) for v in value]
+    else:
+        allocation = ["0.00"] * len(rows)
+
+    columns = {
+        "stock": stock_ids,
+        "name": names,
+        "quantity": quantities,
+        "avg_price": _money(avg_prices),
+        "current_price": _money(prices),
+        "market_value": _money(value),
+        "cost_basis": _money(cost),
+        "unrealized_pnl": _money(unrealized),
+        "realized_pnl": _money(realized),
+        "allocation": allocation,
+    }
+    fields = list(columns)
+    return {
+        "holdings": [dict(zip(fields, row)) for row in zip(*columns.values())],
+        "totals": {
+            "market_value": str(total_value.quantize(CENT)),
+            "cost_basis": str(total_cost.quantize(CENT)),
+            "unrealized_pnl": str((total_value - total_cost).quantize(CENT)),
+            "realized_pnl": str(sum(realized).quantize(CENT)),
+        },
+    }
+
+
+class PortfolioCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        """The user's valuation, recomputed only if a fill or price has moved it."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None:
+            stamp, keys, valuation = entry
+            if generations.unchanged_since(stamp, keys):
+                with self._lock:
+                    if user_id in self._entries:
+                        self._entries.move_to_end(user_id)
+                return valuation
+
+        stamp = generations.now()
+        valuation = value_portfolio(user_id)
+        keys = [user_key(user_id)] + [stock_key(row["stock"]) for row in valuation["holdings"]]
+        with self._lock:
+            self._entries[user_id] = (stamp, keys, valuation)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > getattr(settings, "PORTFOLIO_CACHE_SIZE", 10000):
+                self._entries.popitem(last=False)
+        return valuation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+portfolios = PortfolioCache()
+
@@ -0,0 +1,57 @@
+"""
+Cached list responses validated by generation counters.
+
+An entry keeps the response data, its ETag (a hash of the rendered body,
+so it means the same thing in every process) and the ``generations``
+reading taken before it was built. It is served, and a matching
+If-None-Match answered with 304, for as long as none of the keys it
+depends on has changed: the stock list on any stock's price or details,
+a user's orders and holdings on their orders, fills and holdings.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+
+from .generations import generations
+
+
+class ResponseCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def stamp(self):
+        """Take before building a response to ``put``."""
+        return generations.now()
+
+    def get(self, key, keys):
+        """``(etag, data)`` if cached and still current, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stamp, etag, data = entry
+            if not generations.unchanged_since(stamp, keys):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return etag, data
+
+    def put(self, key, stamp, keys, data):
+        etag = '"%s"' % hashlib.blake2b(JSONRenderer().render(data), digest_size=16).hexdigest()
+        with self._lock:
+            self._entries[key] = (stamp, etag, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > getattr(settings, "RESPONSE_CACHE_SIZE", 10000):
+                self._entries.popitem(last=False)
+        return etag, data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+responses = ResponseCache()
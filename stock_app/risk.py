@@ -0,0 +1,219 @@
+"""
+Pre-trade risk: each user's cash and shares net of their open orders.
+
+An account is loaded from the database the first time a user places an
+order in this process (balance, holdings and what their open orders
+already reserve) and is then kept in step in memory:
+
+- order entry checks and reserves in one step, so two orders can't both
+  spend the same cash or shares;
+- settlement moves balances and holdings and releases what each fill
+  used, under the account locks until the pass commits;
+- cancels, expiries and unfilled IOC/FOK/market remainders release the
+  rest.
+
+Because everything an order needs is reserved before it reaches the
+matcher, a match never runs out of funds halfway through a sweep.
+Whenever the in-memory state may be wrong (a failed pass, a balance edited
+outside settlement) the account is forgotten and reloaded on next use.
+"""
+import threading
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+
+from django.db.models import F, Sum
+
+from .models import Order, User, UserHolding
+from .orderbook import _IS_OPEN
+
+
+class InsufficientFunds(Exception):
+    """An order needs more cash or shares than the user has available."""
+
+
+class Account:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = threading.RLock()
+        self.loaded = False
+
+    def load(self):
+        self.balance = User.objects.values_list("balance", flat=True).get(pk=self.user_id)
+        self.shares = dict(
+            UserHolding.objects.filter(user_id=self.user_id, quantity__gt=0)
+            .values_list("stock_id", "quantity")
+        )
+        self.reserved_cash = Decimal(0)
+        self.reserved_shares = {}
+        open_orders = (
+            Order.objects.filter(_IS_OPEN, user_id=self.user_id)
+            .values("order_type", "stock_id")
+            .annotate(quantity=Sum("remaining_quantity"), notional=Sum(F("price") * F("remaining_quantity")))
+        )
+        for row in open_orders:
+            if row["order_type"] == Order.BUY:
+                self.reserved_cash += row["notional"] or 0
+            else:
+                self.reserved_shares[row["stock_id"]] = (
+                    self.reserved_shares.get(row["stock_id"], 0) + row["quantity"]
+                )
+        self.loaded = True
+
+    @property
+    def available_cash(self):
+        return self.balance - self.reserved_cash
+
+    def available_shares(self, stock_id):
+        """Shares free to sell, or None if the user holds none at all."""
+        held = self.shares.get(stock_id)
+        if held is None:
+            return None
+        return held - self.reserved_shares.get(stock_id, 0)
+
+    def _release_shares(self, stock_id, qty):
+        self.reserved_shares[stock_id] = max(self.reserved_shares.get(stock_id, 0) - qty, 0)
+
+    def _release_cash(self, amount):
+        self.reserved_cash = max(self.reserved_cash - amount, Decimal(0))
+
+
+class Accounts:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+
+    def _account(self, user_id):
+        account = self._accounts.get(user_id)
+        if account is None:
+            with self._lock:
+                account = self._accounts.setdefault(user_id, Account(user_id))
+        return account
+
+    def get(self, user_id):
+        """The user's loaded account."""
+        account = self._account(user_id)
+        with account.lock:
+            if not account.loaded:
+                account.load()
+        return account
+
+    def reserve(self, user_id, stock, order_type, price, qty):
+        """
+        Check an order against what the user has available and reserve what
+        it needs. Market buys (no price) reserve when they are matched.
+        Raises InsufficientFunds.
+        """
+        account = self.get(user_id)
+        with account.lock:
+            if order_type == Order.BUY:
+                if price is None:
+                    return
+                total_cost = price * qty
+                if account.available_cash < total_cost:
+                    raise InsufficientFunds(
+                        f"Insufficient balance. Required: {total_cost:.2f}, Available: {account.available_cash:.2f}"
+                    )
+                account.reserved_cash += total_cost
+            else:
+                available = account.available_shares(stock.id)
+                if available is None:
+                    raise InsufficientFunds(f"You don't own any shares of {stock.get_identifier()}")
+                if available < qty:
+                    raise InsufficientFunds(
+                        f"Insufficient shares. You have only {available} shares of {stock.get_identifier()}"
+                    )
+                account.reserved_shares[stock.id] = account.reserved_shares.get(stock.id, 0) + qty
+
+    def reserve_budget(self, user_id):
+        """Reserve all of a user's available cash for a market buy; returns it."""
+        account = self.get(user_id)
+        with account.lock:
+            budget = max(account.available_cash, Decimal(0))
+            account.reserved_cash += budget
+            return budget
+
+    def release_cash(self, user_id, amount):
+        account = self._accounts.get(user_id)
+        if account is not None:
+            with account.lock:
+                if account.loaded:
+                    account._release_cash(amount)
+
+    def release(self, order):
+        """Release what an order's unfilled remainder reserved (cancel, expiry, IOC)."""
+        if order.price is None and order.order_type == Order.BUY:
+            return
+        account = self._accounts.get(order.user_id)
+        if account is None:
+            return
+        with account.lock:
+            if not account.loaded:
+                return
+            if order.order_type == Order.BUY:
+                account._release_cash(order.price * order.remaining_quantity)
+            else:
+                account._release_shares(order.stock_id, order.remaining_quantity)
+
+    def adjust(self, order, price, remaining):
+        """
+        Re-reserve an amended order: from its current price and remaining
+        quantity to ``price`` and ``remaining``. Raises InsufficientFunds.
+        """
+        account = self.get(order.user_id)
+        with account.lock:
+            if order.order_type == Order.BUY:
+                delta = price * remaining - order.price * order.remaining_quantity
+                if delta > account.available_cash:
+                    raise InsufficientFunds(
+                        f"Insufficient balance. Required: {delta:.2f} more, Available: {account.available_cash:.2f}"
+                    )
+                account.reserved_cash += delta
+            else:
+                delta = remaining - order.remaining_quantity
+                available = account.available_shares(order.stock_id) or 0
+                if delta > available:
+                    raise InsufficientFunds(f"Insufficient shares. You have only {available} more shares available")
+                account.reserved_shares[order.stock_id] = account.reserved_shares.get(order.stock_id, 0) + delta
+
+    @contextmanager
+    def locked(self, user_ids):
+        """Hold these users' account locks, in a fixed order, e.g. until a settlement commits."""
+        with ExitStack() as stack:
+            for user_id in sorted(user_ids):
+                stack.enter_context(self._account(user_id).lock)
+            yield
+
+    def apply_fill(self, buy_order, sell_order, qty, price, stock_id):
+        """
+        Move cash and shares for one fill and release what it used. The
+        caller holds both accounts' locks (see ``locked``).
+        """
+        cost = price * qty
+        buyer = self._accounts.get(buy_order.user_id)
+        if buyer is not None and buyer.loaded:
+            buyer.balance -= cost
+            buyer.shares[stock_id] = buyer.shares.get(stock_id, 0) + qty
+            # Limit buys reserved at their limit; market buys' budget at cost.
+            buyer._release_cash(cost if buy_order.price is None else buy_order.price * qty)
+        seller = self._accounts.get(sell_order.user_id)
+        if seller is not None and seller.loaded:
+            seller.balance += cost
+            seller.shares[stock_id] = seller.shares.get(stock_id, 0) - qty
+            if seller.shares[stock_id] <= 0:
+                del seller.shares[stock_id]
+            seller._release_shares(stock_id, qty)
+
+    def forget(self, user_ids):
+        """Drop in-memory accounts so they are reloaded from the database."""
+        for user_id in user_ids:
+            account = self._accounts.get(user_id)
+            if account is not None:
+                with account.lock:
+                    account.loaded = False
+
+    def clear(self):
+        with self._lock:
+            self._accounts.clear()
+
+
+accounts = Accounts()
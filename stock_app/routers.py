@@ -0,0 +1,111 @@
+"""
+Read-replica routing for the list endpoints.
+
+Every query goes to the primary unless it runs inside ``replica_reads``,
+which the read-only list views wrap around their queries. Matching,
+settlement and authentication therefore always use the primary. A user
+who has just submitted an order (or a cancel or amendment) is pinned to
+the primary for ``STICKY_SECONDS``, longer than the replicas normally lag,
+so they always read their own writes.
+
+Configured by the ``READ_REPLICAS`` setting::
+
+    READ_REPLICAS = {
+        "ALIASES": [],          # DATABASES aliases to read from; [] disables
+        "STICKY_SECONDS": 5,    # primary-only reads after a user's write
+        "SHARED_CACHE": None,   # CACHES alias so every process sees the pin
+    }
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {"ALIASES": [], "STICKY_SECONDS": 5, "SHARED_CACHE": None}
+
+_read_alias = ContextVar("read_alias", default=None)
+_next = itertools.count()
+
+
+def _config():
+    return {**DEFAULTS, **getattr(settings, "READ_REPLICAS", {})}
+
+
+class Pins:
+    """Users whose reads must stay on the primary, until a deadline."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = {}
+
+    def pin(self, user_id):
+        config = _config()
+        if not config["ALIASES"] or user_id is None:
+            return
+        seconds = config["STICKY_SECONDS"]
+        with self._lock:
+            self._until[user_id] = time.monotonic() + seconds
+            if len(self._until) > 10000:
+                now = time.monotonic()
+                self._until = {uid: until for uid, until in self._until.items() if until > now}
+        if config["SHARED_CACHE"]:
+            caches[config["SHARED_CACHE"]].set(f"primary-pin:{user_id}", True, seconds)
+
+    def pinned(self, user_id):
+        config = _config()
+        until = self._until.get(user_id)
+        if until is not None and until > time.monotonic():
+            return True
+        if config["SHARED_CACHE"]:
+            return bool(caches[config["SHARED_CACHE"]].get(f"primary-pin:{user_id}"))
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._until.clear()
+
+
+pins = Pins()
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """Route reads to a replica (round robin), unless ``user_id`` is pinned."""
+    aliases = _config()["ALIASES"]
+    alias = None
+    if aliases and not (user_id is not None and pins.pinned(user_id)):
+        alias = aliases[next(_next) % len(aliases)]
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Route reads to the primary, even inside ``replica_reads``."""
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary.
+        return db not in _config()["ALIASES"]
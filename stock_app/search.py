@@ -0,0 +1,126 @@
+"""
+In-process prefix index over stock names for /api/stocks/search/.
+
+Names are case-folded and kept in a sorted array, so a prefix query is two
+bisects to find the matching range and never touches the database. The
+index is built from the Stock table on first use and kept current by the
+Stock save/delete signals and by the matcher's price updates.
+"""
+import copy
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+from .models import Stock
+from .routers import primary_reads
+from .serializers import StockSerializer
+
+
+# Sorts after any character a name can continue with, so every name that
+# starts with ``prefix`` sorts before ``prefix + _MAX_CHAR``.
+_MAX_CHAR = chr(0x10FFFF)
+
+
+class StockPrefixIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._stocks = {}
+
+    def load(self, stocks):
+        with self._lock:
+            self._stocks = {stock.id: self._entry(stock) for stock in stocks}
+            self._keys = sorted((entry[0], stock_id) for stock_id, entry in self._stocks.items())
+
+    @staticmethod
+    def _entry(stock):
+        return stock.name.casefold(), StockSerializer(stock).data, stock
+
+    def add(self, stock):
+        with self._lock:
+            self._discard(stock.id)
+            entry = self._stocks[stock.id] = self._entry(stock)
+            insort(self._keys, (entry[0], stock.id))
+
+    def update(self, stock_id, fields):
+        """Apply changed field values to an indexed stock (the name must not change)."""
+        with self._lock:
+            entry = self._stocks.get(stock_id)
+            if entry is None:
+                return
+            stock = copy.copy(entry[2])
+            for name, value in fields.items():
+                setattr(stock, name, value)
+            self._stocks[stock_id] = self._entry(stock)
+
+    def remove(self, stock_id):
+        with self._lock:
+            self._discard(stock_id)
+
+    def _discard(self, stock_id):
+        entry = self._stocks.pop(stock_id, None)
+        if entry is not None:
+            key = (entry[0], stock_id)
+            del self._keys[bisect_left(self._keys, key)]
+
+    def get(self, stock_id):
+        entry = self._stocks.get(stock_id)
+        return entry[1] if entry else None
+
+    def search(self, prefix, limit):
+        """
+        Up to ``limit`` stocks whose name starts with ``prefix``, ranked by
+        exact match first, then shorter names, then alphabetically.
+        """
+        prefix = prefix.casefold()
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            end = bisect_left(self._keys, (prefix + _MAX_CHAR,), start)
+            matches = self._keys[start:end]
+            best = heapq.nsmallest(
+                limit, matches, key=lambda key: (key[0] != prefix, len(key[0]), key)
+            )
+            return [self._stocks[stock_id][1] for _, stock_id in best]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_stock_index():
+    """
+    Return the process-wide index, building it from the Stock table on first
+    use. It is read from the primary: a replica may still be missing a new
+    stock, which would then be left out for the life of the process.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = StockPrefixIndex()
+                with primary_reads():
+                    index.load(Stock.objects.all())
+                _index = index
+    return _index
+
+
+def stock_saved(stock):
+    if _index is not None:
+        _index.add(stock)
+
+
+def stock_prices_changed(stock_id, fields):
+    """Called by the matcher after it writes a stock's price and session stats."""
+    if _index is not None:
+        _index.update(stock_id, fields)
+
+
+def stock_deleted(stock_id):
+    if _index is not None:
+        _index.remove(stock_id)
+
+
+def reset_stock_index():
+    global _index
+    with _index_lock:
+        _index = None
@@ -0,0 +1,129 @@
+"""
+Single-writer matching sequencer.
+
+Orders are partitioned by stock onto a fixed number of shards. Each shard
+is a FIFO queue drained by one worker thread, so all orders for a stock are
+matched serially in arrival order and the matcher never has to take row
+locks, while different stocks are matched in parallel. Cancels and
+amendments go through the same queues, so they apply in order with the
+rest of the stock's order flow.
+
+Books and shards live in the process that owns them: run the matcher in a
+single process (e.g. one ASGI/WSGI worker with threads) so each stock has
+exactly one writer.
+
+Setting ``MATCHING_SHARDS`` to 0 matches inline in the calling thread,
+which is what the test-suite uses. Matching always reads from the primary
+database, never a read replica.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from .routers import pins, primary_reads
+from .services import OrderConflict, match_orders
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# A shard idle this long gives up its database connection (subject to
+# CONN_MAX_AGE); a busy one keeps it, with its pragmas and page cache.
+IDLE_SECONDS = 30
+
+
+class Sequencer:
+    def __init__(self, shards):
+        self.shards = shards
+        self._queues = [queue.Queue() for _ in range(shards)]
+        self._threads = []
+        for index, q in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run, args=(q,), name=f"matching-shard-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def shard_for(self, stock_id):
+        return stock_id % self.shards
+
+    def submit(self, order, action=match_orders):
+        """Queue ``action(order)``. The future resolves to the order once it has run."""
+        future = Future()
+        self._queues[self.shard_for(order.stock_id)].put((action, order, future))
+        return future
+
+    def stop(self):
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, q):
+        while True:
+            try:
+                item = q.get(timeout=IDLE_SECONDS)
+            except queue.Empty:
+                close_old_connections()
+                continue
+            if item is _STOP:
+                # Whatever CONN_MAX_AGE says: nothing will use it again.
+                connection.close()
+                return
+            action, order, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with primary_reads():
+                    action(order)
+            except OrderConflict as exc:
+                future.set_exception(exc)
+            except Exception as exc:
+                logger.exception("Matching failed for order %s", order.pk)
+                # Drops the connection if the failure left it unusable.
+                close_old_connections()
+                future.set_exception(exc)
+            else:
+                future.set_result(order)
+
+
+_sequencer = None
+_sequencer_lock = threading.Lock()
+
+
+def get_sequencer():
+    global _sequencer
+    shards = getattr(settings, "MATCHING_SHARDS", 0)
+    if _sequencer is None or _sequencer.shards != shards:
+        with _sequencer_lock:
+            if _sequencer is None or _sequencer.shards != shards:
+                if _sequencer is not None:
+                    _sequencer.stop()
+                _sequencer = Sequencer(shards)
+    return _sequencer
+
+
+def submit_order(order, action=match_orders):
+    """
+    Hand a saved order to the matching engine and return a Future for it.
+    ``action`` is what the engine does with it: match it by default, or
+    e.g. ``cancel_order``. Runs inline when sequencing is disabled. The
+    order's user reads from the primary for a while afterwards, so they
+    see the result.
+    """
+    pins.pin(order.user_id)
+    if getattr(settings, "MATCHING_SHARDS", 0) <= 0:
+        future = Future()
+        try:
+            with primary_reads():
+                action(order)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(order)
+        return future
+    return get_sequencer().submit(order, action)
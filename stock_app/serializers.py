@@ -1,7 +1,10 @@
 from rest_framework import serializers
-from .models import Stock, Order, Trade, UserHolding
+from rest_framework.settings import api_settings
+from .models import Stock, Order, Trade, UserHolding, Candle
+from .risk import InsufficientFunds, accounts
 from django.contrib.auth import get_user_model
 from django.core.validators import EmailValidator
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -51,6 +54,7 @@ class StockSerializer(serializers.ModelSerializer):
     class Meta:
         model = Stock
         fields = "__all__"
+        read_only_fields = ("session_date", "session_high", "session_low", "session_volume", "vwap")
 
     def validate_name(self, value):
         if Stock.objects.filter(name__iexact=value).exists():
@@ -59,50 +63,103 @@ class StockSerializer(serializers.ModelSerializer):
 
 
 
+class PrefetchedStockField(serializers.PrimaryKeyRelatedField):
+    """Resolves stock ids from ``context["stocks"]`` (an in_bulk map) when given."""
+
+    def to_internal_value(self, data):
+        stocks = self.context.get("stocks")
+        if stocks is None:
+            return super().to_internal_value(data)
+        try:
+            return stocks[int(data)]
+        except (KeyError, TypeError, ValueError):
+            self.fail("does_not_exist", pk_value=data)
+
+
 class OrderSerializer(serializers.ModelSerializer):
+    stock = PrefetchedStockField(queryset=Stock.objects.all())
+
     class Meta:
         model = Order
         fields = "__all__"
         read_only_fields = ("user", "remaining_quantity", "status", "timestamp")
 
     def validate(self, data):
-        
-        request = self.context.get('request')
-        user = request.user if request else None
-        
-        
-        if data["price"] <= 0:
+        price = data.get("price")
+        time_in_force = data.get("time_in_force")
+        if data.get("kind", Order.LIMIT) == Order.MARKET:
+            if price is not None:
+                raise serializers.ValidationError("Market orders take no price.")
+            if time_in_force is None:
+                data["time_in_force"] = time_in_force = Order.IOC
+            elif time_in_force not in (Order.IOC, Order.FOK):
+                raise serializers.ValidationError("Market orders must be IOC or FOK.")
+        elif price is None:
+            raise serializers.ValidationError("Limit orders need a price.")
+        elif price <= 0:
             raise serializers.ValidationError("Price must be positive.")
         
         if data["quantity"] <= 0:
             raise serializers.ValidationError("Quantity must be positive.")
-        
-        
-        if data["order_type"] == "BUY" and user:
-            total_cost = data["price"] * data["quantity"]
-            if user.balance < total_cost:
-                raise serializers.ValidationError(
-                    f"Insufficient balance. Required: {total_cost:.2f}, Available: {user.balance:.2f}"
-                )
-        
-        
-        if data["order_type"] == "SELL" and user:
-            try:
-                stock_identifier = data["stock"].get_identifier()
-                
-                holding = UserHolding.objects.get(user=user, stock=data["stock"])
-                if holding.quantity < data["quantity"]:
-                    raise serializers.ValidationError(
-                        f"Insufficient shares. You have only {holding.quantity} shares of {stock_identifier}"
-                    )
-            except UserHolding.DoesNotExist:
-                stock_identifier = data["stock"].get_identifier()
-                raise serializers.ValidationError(
-                    f"You don't own any shares of {stock_identifier}"
-                )
+
+        if time_in_force == Order.GTD:
+            if data.get("expires_at") is None:
+                raise serializers.ValidationError("GTD orders need expires_at.")
+            if data["expires_at"] <= timezone.now():
+                raise serializers.ValidationError("expires_at must be in the future.")
+        elif data.get("expires_at") is not None:
+            raise serializers.ValidationError("expires_at is only for GTD orders.")
         
         return data
 
+    def create(self, validated_data):
+        # Reserved on save, not in validate, so an order that is validated
+        # but never saved holds nothing back.
+        order = Order(**validated_data)
+        reserve_order(order)
+        try:
+            return super().create(validated_data)
+        except Exception:
+            accounts.release(order)
+            raise
+
+
+def reserve_order(order):
+    """
+    Reserve what an unsaved order needs from its user's risk account.
+    Raises ValidationError if they can't cover it.
+    """
+    try:
+        accounts.reserve(order.user_id, order.stock, order.order_type, order.price, order.quantity)
+    except InsufficientFunds as e:
+        raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [str(e)]})
+
+
+class OrderAmendSerializer(serializers.Serializer):
+    """New limit price and/or total quantity for an open order (``instance``)."""
+    price = serializers.DecimalField(max_digits=12, decimal_places=2, required=False)
+    quantity = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        order = self.instance
+        if order.kind == Order.MARKET:
+            raise serializers.ValidationError("Market orders can't be amended.")
+        if not data:
+            raise serializers.ValidationError("Provide a new price and/or quantity.")
+        price = data.get("price", order.price)
+        quantity = data.get("quantity", order.quantity)
+
+        if price <= 0:
+            raise serializers.ValidationError("Price must be positive.")
+
+        filled = order.quantity - order.remaining_quantity
+        if quantity <= filled:
+            raise serializers.ValidationError(
+                f"Quantity must be more than the {filled} already filled."
+            )
+
+        return data
+
 
 class TradeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -113,3 +170,9 @@ class UserHoldingSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserHolding
         fields = "__all__"
+
+
+class CandleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Candle
+        fields = ("interval", "start", "open", "high", "low", "close", "volume")
@@ -1,120 +1,483 @@
 from django.db import transaction
-from .models import Order, Trade, UserHolding
-from decimal import Decimal
+from django.utils import timezone
+from .models import Order, Stock, Trade, UserHolding
+from .authentication import token_cache
+from .candles import CandleAggregator, save_candles
+from .events import broker, stock_topic, user_topic
+from .expiry import sweeper
+from .instrumentation import span
+from .journal import encode_order, get_journal
+from .generations import data_changed
+from .risk import InsufficientFunds, accounts
+from .orderbook import OPEN_STATUSES, crosses, discard_book, from_ticks, get_book, opposite_side, to_ticks
+from .search import stock_prices_changed
 
-def update_holdings_after_trade(buyer, seller, stock, qty, price):
-    """Update buyer and seller holdings atomically (caller should be in transaction)."""
+# Price levels per side sent with streamed book updates.
+STREAM_BOOK_DEPTH = 5
+
+
+class OrderConflict(Exception):
+    """The order's current state doesn't allow the requested cancel or amendment."""
+
+class Position:
+    """A user's holding in the stock during a settlement, with prices in ticks."""
+
+    __slots__ = ("holding", "quantity", "avg", "realized")
+
+    def __init__(self, holding=None):
+        self.holding = holding
+        if holding is None:
+            self.quantity = self.avg = self.realized = 0
+        else:
+            self.quantity = holding.quantity
+            self.avg = to_ticks(holding.avg_price)
+            self.realized = to_ticks(holding.realized_pnl)
+
+
+def _divide(numerator, denominator):
+    """Integer division rounded half to even, as Decimal.quantize rounds."""
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+def update_holdings_after_trade(buyer_id, seller_id, qty, price, balances, positions):
+    """
+    Apply one fill, in ticks, to the in-memory balances and positions of a
+    settlement. ``balances`` maps user id to balance and ``positions`` user
+    id to that user's Position in the stock (missing if they hold none);
+    nothing is written here.
+    """
     total_cost = price * qty
-    if buyer.balance < total_cost:
-        raise ValueError(f"Buyer has insufficient balance. Required: {total_cost}, Available: {buyer.balance}")
-    
-    buyer.balance -= total_cost
-    buyer.save()
-
-    
-    seller.balance += total_cost
-    seller.save()
-    
-    holding, created = UserHolding.objects.get_or_create(
-        user=buyer, stock=stock, defaults={"quantity": 0, "avg_price": price}
-    )
-    if not created:
-        
-        total_cost = (holding.avg_price * holding.quantity) + (Decimal(price) * qty)
-        new_qty = holding.quantity + qty
-        holding.avg_price = (total_cost / new_qty).quantize(Decimal("0.01"))
-        holding.quantity = new_qty
+    if balances[buyer_id] < total_cost:
+        raise ValueError(
+            f"Buyer has insufficient balance. Required: {from_ticks(total_cost)}, "
+            f"Available: {from_ticks(balances[buyer_id])}"
+        )
+    balances[buyer_id] -= total_cost
+    balances[seller_id] += total_cost
+
+    position = positions.get(buyer_id)
+    if position is None:
+        position = positions[buyer_id] = Position()
+    if position.quantity > 0:
+        new_qty = position.quantity + qty
+        position.avg = _divide(position.avg * position.quantity + total_cost, new_qty)
+        position.quantity = new_qty
     else:
-        holding.quantity = qty
-        holding.avg_price = Decimal(price).quantize(Decimal("0.01"))
-    holding.save()
+        position.quantity = qty
+        position.avg = price
+
+    seller_position = positions.get(seller_id)
+    if seller_position is not None and seller_position.quantity > 0:
+        sold = min(qty, seller_position.quantity)
+        seller_position.realized += (price - seller_position.avg) * sold
+        # Closed positions keep their row (at quantity 0) for the realized P&L.
+        seller_position.quantity -= sold
+
+
+def settle_fills(stock_id, fills):
+    """
+    Persist every fill of one matching pass with a fixed number of queries.
+
+    ``fills`` is a list of ``(buy_order, sell_order, qty, price)`` in
+    execution order, with the price in ticks; the orders (model instances
+    or book records) already carry their new remaining quantity and status.
+    Balances and holdings are loaded once, updated in integer ticks fill by
+    fill and converted back and written in bulk. Must run inside a transaction,
+    with the users' risk accounts locked (``accounts.locked``) so they move
+    with the database. Returns the created trades.
+    """
+    from .models import User
+
+    if not fills:
+        return []
+
+    user_ids = set()
+    orders = {}
+    for buy_order, sell_order, qty, price in fills:
+        user_ids.update((buy_order.user_id, sell_order.user_id))
+        orders[buy_order.id] = buy_order
+        orders[sell_order.id] = sell_order
+
+    # Row locks keep another process (or any transaction outside the
+    # matcher) from writing a balance between this read and the write back;
+    # taken in id order so two settlements can't deadlock. SQLite, which
+    # serializes writers anyway, has no row locks and ignores them.
+    users = {
+        user.id: user for user in User.objects.select_for_update().filter(pk__in=user_ids).order_by("pk")
+    }
+    balances = {user_id: to_ticks(user.balance) for user_id, user in users.items()}
+    positions = {
+        holding.user_id: Position(holding)
+        for holding in UserHolding.objects.filter(stock_id=stock_id, user_id__in=user_ids)
+    }
+
+    trades = []
+    for buy_order, sell_order, qty, price in fills:
+        update_holdings_after_trade(buy_order.user_id, sell_order.user_id, qty, price, balances, positions)
+        trades.append(Trade(
+            buy_order_id=buy_order.id,
+            sell_order_id=sell_order.id,
+            buyer_id=buy_order.user_id,
+            seller_id=sell_order.user_id,
+            stock_id=stock_id,
+            price=from_ticks(price),
+            quantity=qty,
+        ))
+
+    Trade.objects.bulk_create(trades)
+    Order.objects.bulk_update([
+        order if isinstance(order, Order)
+        else Order(id=order.id, remaining_quantity=order.remaining_quantity, status=order.status)
+        for order in orders.values()
+    ], ["remaining_quantity", "status"])
+    for user_id, user in users.items():
+        user.balance = from_ticks(balances[user_id])
+    User.objects.bulk_update(users.values(), ["balance"])
+
+    created, changed = [], []
+    for user_id, position in positions.items():
+        holding = position.holding
+        if holding is None:
+            if position.quantity > 0:
+                created.append(UserHolding(
+                    user_id=user_id, stock_id=stock_id, quantity=position.quantity,
+                    avg_price=from_ticks(position.avg),
+                ))
+            continue
+        holding.quantity = position.quantity
+        holding.avg_price = from_ticks(position.avg)
+        holding.realized_pnl = from_ticks(position.realized)
+        changed.append(holding)
+    if created:
+        UserHolding.objects.bulk_create(created)
+    if changed:
+        UserHolding.objects.bulk_update(changed, ["quantity", "avg_price", "realized_pnl"])
+
+    for buy_order, sell_order, qty, price in fills:
+        accounts.apply_fill(buy_order, sell_order, qty, from_ticks(price), stock_id)
+
+    # Balances, holdings and the price changed without save(), so cached
+    # auth users, valuations and responses must be dropped.
+    transaction.on_commit(lambda: token_cache.invalidate_users(users.keys()))
+    data_changed(users.keys(), [stock_id])
+
+    # Keep the caller's user objects (e.g. request.user) in step.
+    for order in orders.values():
+        if isinstance(order, Order) and Order.user.is_cached(order):
+            order.user.balance = users[order.user_id].balance
+
+    return trades
 
-   
-    try:
-        seller_holding = UserHolding.objects.get(user=seller, stock=stock)
-        if seller_holding.quantity < qty:
-           
-            seller_holding.quantity = 0
-            seller_holding.delete()
-        else:
-            seller_holding.quantity -= qty
-            if seller_holding.quantity == 0:
-                seller_holding.delete()
-            else:
-                seller_holding.save()
-    except UserHolding.DoesNotExist:
-       
-        pass
 
 def match_orders(new_order):
     """
     Core matching engine.
     new_order should be saved already (with remaining_quantity set).
+
+    Resting liquidity comes from the stock's in-memory order book, so the
+    cost of a match depends on the fills it produces rather than on the
+    size of the Order table. Any unfilled remainder rests in the book.
     """
     from .models import User
 
     if new_order.remaining_quantity == 0:
         return
-    
-    if new_order.order_type == Order.BUY:
-        total_cost = new_order.price * new_order.quantity
-        if new_order.user.balance < total_cost:
-          
-            new_order.status = Order.PENDING 
-            new_order.remaining_quantity = new_order.quantity
-            new_order.save()
+
+    with span("match_orders"):
+        _match_orders(new_order)
+
+
+def _match_orders(new_order):
+    # Fetched first: on first use the journal restores the books it recovered.
+    journal = get_journal()
+    book = get_book(new_order.stock_id)
+    with book.lock:
+        # An order already in the table when the book was loaded may have
+        # been resting (and trading) before it reached us; the book or the
+        # table then knows its real remaining quantity, not this instance.
+        resting = book.remove(new_order.id)
+        if resting is not None:
+            new_order.remaining_quantity = resting.remaining_quantity
+            new_order.status = resting.status
+        elif new_order.id <= book.loaded_up_to:
+            new_order.refresh_from_db(fields=["remaining_quantity", "status"])
+        if new_order.remaining_quantity == 0:
             return
-        
-
-    if new_order.order_type == Order.BUY:
-        opposite_qs = Order.objects.filter(
-            stock=new_order.stock,
-            order_type=Order.SELL,
-            price__lte=new_order.price,
-            status__in=[Order.PENDING, Order.PARTIAL],
-        ).order_by("price", "timestamp")
+        _run_pass(book, journal, new_order)
+
+
+def _run_pass(book, journal, new_order):
+    """Match an order that isn't resting against the book and journal the pass."""
+    entry = encode_order(new_order) if journal is not None else None
+    try:
+        fills, expired = _match_against_book(book, new_order)
+    except Exception:
+        discard_book(new_order.stock_id)
+        accounts.clear()
+        raise
+    if journal is not None:
+        # A pass without fills journals the order as it now rests.
+        journal.record_pass(
+            new_order.stock_id, entry if fills else encode_order(new_order), fills, new_order.rests, expired
+        )
+
+
+def _current_state(book, order):
+    """Sync ``order`` with the engine's view of it; returns its resting copy, if any."""
+    resting = book.get(order.id)
+    if resting is not None:
+        order.remaining_quantity = resting.remaining_quantity
+        order.status = resting.status
     else:
-        opposite_qs = Order.objects.filter(
-            stock=new_order.stock,
-            order_type=Order.BUY,
-            price__gte=new_order.price,
-            status__in=[Order.PENDING, Order.PARTIAL],
-        ).order_by("-price", "timestamp")
-
-    with transaction.atomic():
-        for opp in opposite_qs.select_for_update():
-            if new_order.remaining_quantity == 0:
-                break
+        order.refresh_from_db(fields=["remaining_quantity", "status"])
+    if order.status not in OPEN_STATUSES:
+        raise OrderConflict(f"Order {order.id} is {order.status.lower()}.")
+    return resting
+
+
+def cancel_order(order):
+    """
+    Take an order out of its book and mark it CANCELLED; remaining_quantity
+    keeps the unfilled quantity. Removal is a dict lookup plus, when the
+    order was alone at its price, a bisect. Raises OrderConflict if the
+    order is already filled or cancelled.
+    """
+    journal = get_journal()
+    book = get_book(order.stock_id)
+    with book.lock:
+        _current_state(book, order)
+        try:
+            book.remove(order.id)
+            order.status = Order.CANCELLED
+            order.save(update_fields=["status", "remaining_quantity"])
+        except Exception:
+            discard_book(order.stock_id)
+            raise
+        accounts.release(order)
+        if journal is not None:
+            journal.append({"type": "cancel", "stock": order.stock_id, "order": order.id})
+        _publish_pass(book, order, [])
+    return order
+
+
+def expire_order(order, now=None):
+    """
+    Expire a good-till-date order that is due by ``now``. Run by the expiry
+    sweeper; a no-op once the order has traded away or been cancelled.
+    """
+    now = now or timezone.now()
+    journal = get_journal()
+    book = get_book(order.stock_id)
+    with book.lock:
+        resting = book.get(order.id)
+        if resting is None or resting.expires_at is None or resting.expires_at > now:
+            return order
+        try:
+            book.remove(order.id)
+            resting.status = Order.EXPIRED
+            Order.objects.filter(pk=order.id).update(status=Order.EXPIRED)
+        except Exception:
+            discard_book(order.stock_id)
+            raise
+        accounts.release(resting)
+        if journal is not None:
+            journal.append({"type": "expire", "stock": order.stock_id, "order": order.id})
+        _publish_pass(book, resting, [])
+    return resting
 
-            matched_qty = min(new_order.remaining_quantity, opp.remaining_quantity)
-           
-            trade_price = opp.price
-
-           
-            Trade.objects.create(
-                buy_order=new_order if new_order.order_type == Order.BUY else opp,
-                sell_order=opp if new_order.order_type == Order.BUY else new_order,
-                stock=new_order.stock,
-                price=trade_price,
-                quantity=matched_qty,
-            )
-
-           
-            new_order.remaining_quantity -= matched_qty
-            opp.remaining_quantity -= matched_qty
-
-            opp.status = Order.COMPLETED if opp.remaining_quantity == 0 else Order.PARTIAL
-            opp.save()
-
-            new_order.status = Order.COMPLETED if new_order.remaining_quantity == 0 else Order.PARTIAL
-            new_order.save()
-
-           
-            if new_order.order_type == Order.BUY:
-                buyer = new_order.user
-                seller = opp.user
+
+def amend_order(order, price=None, quantity=None):
+    """
+    Change an open order's limit price and/or total quantity.
+
+    Lowering the quantity keeps the order's place in its queue. Changing
+    the price or raising the quantity loses it: the order gets a fresh
+    timestamp and is matched again as if it were new, so it may trade
+    straight away. The new quantity must exceed what is already filled.
+    """
+    journal = get_journal()
+    book = get_book(order.stock_id)
+    with book.lock:
+        resting = _current_state(book, order)
+        price = order.price if price is None else price
+        quantity = order.quantity if quantity is None else quantity
+        filled = order.quantity - order.remaining_quantity
+        if quantity <= filled:
+            raise OrderConflict(f"Order {order.id} already has {filled} filled; cancel it instead.")
+
+        keeps_priority = price == order.price and quantity <= order.quantity
+        if keeps_priority and quantity == order.quantity:
+            return order
+        try:
+            accounts.adjust(order, price, quantity - filled)
+        except InsufficientFunds as e:
+            raise OrderConflict(str(e))
+        try:
+            if keeps_priority:
+                cut = order.quantity - quantity
+                if resting is not None:
+                    book.reduce(order.id, cut)
+                    resting.quantity = quantity
+                order.quantity = quantity
+                order.remaining_quantity -= cut
+                order.save(update_fields=["quantity", "remaining_quantity"])
             else:
-                buyer = opp.user
-                seller = new_order.user
+                book.remove(order.id)
+                order.remaining_quantity += quantity - order.quantity
+                order.quantity = quantity
+                order.price = price
+                order.timestamp = timezone.now()
+                order.save(update_fields=["price", "quantity", "remaining_quantity", "timestamp"])
+        except Exception:
+            discard_book(order.stock_id)
+            accounts.forget([order.user_id])
+            raise
+
+        if not keeps_priority:
+            _run_pass(book, journal, order)
+            return order
+        if journal is not None:
+            journal.append({"type": "amend", "stock": order.stock_id, "order": order.id, "cut": cut})
+        _publish_pass(book, order, [])
+    return order
+
+
+def _match_against_book(book, new_order):
+    rests = new_order.rests
+    side = opposite_side(new_order.order_type)
+    fills = []
+    expired = []
+    now = timezone.now()
+    # A market buy takes only what the buyer's available cash covers.
+    budget = None
+    if new_order.order_type == Order.BUY and new_order.price is None:
+        budget = to_ticks(accounts.reserve_budget(new_order.user_id))
+    limit = to_ticks(new_order.price)
+
+    # Fill or kill: judged from the level totals, so no orders are walked
+    # when it can't be filled. Like the loop below, it counts only what the
+    # budget buys and leaves out orders due to expire.
+    killed = new_order.time_in_force == Order.FOK and not book.available(
+        side, limit, new_order.remaining_quantity, budget, now
+    )
 
-            update_holdings_after_trade(buyer, seller, new_order.stock, matched_qty, trade_price)
+    while new_order.remaining_quantity > 0 and not killed:
+        opp = book.best_order(side)
+        if opp is None or not crosses(new_order.order_type, limit, opp):
+            break
+
+        if opp.expires_at is not None and opp.expires_at <= now:
+            # Due but not swept yet; it must not trade.
+            book.remove(opp.id)
+            opp.status = Order.EXPIRED
+            expired.append(opp)
+            continue
+
+        matched_qty = min(new_order.remaining_quantity, opp.remaining_quantity)
+       
+        trade_price = opp.ticks
+
+        if budget is not None:
+            matched_qty = min(matched_qty, budget // trade_price)
+            if matched_qty == 0:
+                break
+            budget -= trade_price * matched_qty
+       
+        new_order.remaining_quantity -= matched_qty
+        book.fill_best(side, matched_qty)
+
+        opp.status = Order.COMPLETED if opp.remaining_quantity == 0 else Order.PARTIAL
+
+        new_order.status = Order.COMPLETED if new_order.remaining_quantity == 0 else Order.PARTIAL
+
+        if new_order.order_type == Order.BUY:
+            fills.append((new_order, opp, matched_qty, trade_price))
+        else:
+            fills.append((opp, new_order, matched_qty, trade_price))
+
+    # IOC, FOK and market orders never rest: what is left is cancelled.
+    cancelled = new_order.remaining_quantity > 0 and not rests
+    if cancelled:
+        new_order.status = Order.CANCELLED
+
+    if fills and book.candles is None:
+        # Resumed before this pass's trades are inserted so they aren't counted twice.
+        book.candles = CandleAggregator.resume(new_order.stock_id)
+
+    user_ids = {order.user_id for fill in fills for order in fill[:2]}
+    with span("settlement"), accounts.locked(user_ids), transaction.atomic():
+        trades = settle_fills(new_order.stock_id, fills)
+        if cancelled and not fills:
+            new_order.save(update_fields=["status"])
+        if expired:
+            Order.objects.filter(pk__in=[order.id for order in expired]).update(status=Order.EXPIRED)
+        finished = []
+        for trade in trades:
+            finished.extend(book.candles.add_trade(trade.price, trade.quantity, trade.timestamp))
+        save_candles(finished)
+        if trades and book.stats is not None:
+            for trade in trades:
+                book.stats.add_trade(trade.price, trade.quantity, trade.timestamp)
+            fields = dict(book.stats.as_fields(), timestamp=timezone.now())
+            Stock.objects.filter(pk=new_order.stock_id).update(**fields)
+
+    if trades:
+        last = trades[-1]
+        book.last_trade = (last.price, last.quantity, last.timestamp)
+        if book.stats is not None:
+            stock_prices_changed(new_order.stock_id, fields)
+
+    if budget is not None:
+        accounts.release_cash(new_order.user_id, from_ticks(budget))
+    if cancelled:
+        accounts.release(new_order)
+    for order in expired:
+        accounts.release(order)
+
+    if new_order.remaining_quantity > 0 and rests:
+        book.add(new_order)
+        if new_order.expires_at is not None:
+            sweeper.schedule(new_order)
+    for order in expired:
+        _publish_pass(book, order, [])
+    _publish_pass(book, new_order, fills)
+    return fills, expired
+
+
+def _publish_pass(book, new_order, fills):
+    """
+    Queue the events of a matching pass for streaming subscribers; they are
+    published once the pass commits. Nothing is built for topics nobody
+    is listening to. The touched orders' users are recorded as changed.
+    """
+    events = []
+    stock = stock_topic(new_order.stock_id)
+    touched = {new_order.id: new_order}
+    for buy_order, sell_order, qty, price in fills:
+        for order in (buy_order, sell_order):
+            touched[order.id] = order
+            topic = user_topic(order.user_id)
+            if broker.has_subscribers(topic):
+                events.append((topic, {
+                    "type": "fill", "order": order.id, "stock": new_order.stock_id,
+                    "side": order.order_type, "price": str(from_ticks(price)), "quantity": qty,
+                }))
+        if broker.has_subscribers(stock):
+            events.append((stock, {
+                "type": "trade", "stock": new_order.stock_id, "price": str(from_ticks(price)), "quantity": qty,
+            }))
+    for order in touched.values():
+        topic = user_topic(order.user_id)
+        if broker.has_subscribers(topic):
+            events.append((topic, {
+                "type": "order", "order": order.id, "stock": order.stock_id,
+                "status": order.status, "remaining_quantity": order.remaining_quantity,
+            }))
+    if broker.has_subscribers(stock):
+        events.append((stock, dict(book.snapshot(STREAM_BOOK_DEPTH), type="book")))
+    data_changed({order.user_id for order in touched.values()})
+    if events:
+        transaction.on_commit(lambda: [broker.publish(topic, event) for topic, event in events])
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .generations import data_changed
+from .models import Order, Stock, User, UserHolding
+from .risk import accounts
+from .search import stock_deleted, stock_saved
+
+
+@receiver(post_save, sender=Stock)
+def index_saved_stock(sender, instance, **kwargs):
+    stock_saved(instance)
+    data_changed(stock_ids=[instance.id])
+
+
+@receiver(post_delete, sender=Stock)
+def unindex_deleted_stock(sender, instance, **kwargs):
+    stock_deleted(instance.id)
+    data_changed(stock_ids=[instance.id])
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def uncache_token(sender, instance, **kwargs):
+    token_cache.invalidate_key(instance.key)
+
+
+@receiver(post_save, sender=User)
+def uncache_user_tokens(sender, instance, **kwargs):
+    token_cache.invalidate_users([instance.pk])
+    accounts.forget([instance.pk])
+
+
+# Settlement keeps risk accounts in step itself (with bulk writes, which
+# send no signals); any other change to a balance or holding reloads them.
+@receiver(post_save, sender=UserHolding)
+@receiver(post_delete, sender=UserHolding)
+def reload_risk_account(sender, instance, **kwargs):
+    accounts.forget([instance.user_id])
+    data_changed([instance.user_id])
+
+
+# Orders saved one at a time (placed, cancelled, amended); the matcher's
+# bulk writes record their changes themselves.
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, **kwargs):
+    data_changed([instance.user_id])
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
@@ -101,24 +101,60 @@
 
 
 
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, time, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import DatabaseError, connection, connections
+from asgiref.sync import sync_to_async
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from decimal import Decimal
-from .models import Stock, Order, Trade, UserHolding
-from .services import match_orders
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory
+from . import instrumentation
+from .authentication import token_cache
+from .benchmark import SCENARIOS, Benchmark, percentile
+from .candles import CandleAggregator, bucket_start
+from .events import broker, stock_topic, user_topic
+from .expiry import sweeper
+from .journal import get_journal, reset_journal
+from .models import Stock, Order, Trade, UserHolding, Candle
+from .orderbook import BookOrder, OrderBook, get_book, open_orders, reset_books
+from .portfolio import portfolios
+from .responses import responses
+from .risk import accounts
+from .routers import ReplicaRouter, pins, primary_reads, replica_reads
+from .search import get_stock_index, reset_stock_index
+from .serializers import OrderSerializer, reserve_order
+from .sequencer import Sequencer
+from .views import TradeListView
+from .services import amend_order, cancel_order, match_orders
 
 User = get_user_model()
 
 class MatchingEngineTests(TestCase):
     def setUp(self):
+        reset_books()
+        accounts.clear()
        
         self.buyer = User.objects.create_user(
             username="buyer", 
+            email="buyer@example.com",
             password="pass",
             balance=Decimal("100000.00") 
         )
         self.seller = User.objects.create_user(
             username="seller", 
+            email="seller@example.com",
             password="pass",
             balance=Decimal("100000.00") 
         )
@@ -241,7 +277,10 @@ class MatchingEngineTests(TestCase):
             remaining_quantity=1
         )
         
-        match_orders(buy)
+        # Orders placed through the API have reserved their cash already;
+        # one that hasn't is refused at settlement, and nothing is written.
+        with self.assertRaises(ValueError):
+            match_orders(buy)
         
         buy.refresh_from_db()
         sell.refresh_from_db()
@@ -249,4 +288,1171 @@ class MatchingEngineTests(TestCase):
 
         self.assertEqual(buy.status, Order.PENDING)  # order not matched because of no money
         self.assertEqual(self.buyer.balance, Decimal("50.00"))  # balance unchanged
-        self.assertEqual(sell.status, Order.PENDING)  # sell order should also remain pending
\ No newline at end of file
+        self.assertEqual(sell.status, Order.PENDING)  # sell order should also remain pending
+
+    def test_stale_cached_balance_does_not_stop_a_match(self):
+        Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                             price=100, quantity=1, remaining_quantity=1)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=1, remaining_quantity=1)
+        buy.user.balance = Decimal("0.00")  # e.g. a request.user loaded before a sale settled
+        match_orders(buy)
+        buy.refresh_from_db()
+        self.assertEqual(buy.status, Order.COMPLETED)
+        self.assertIsNone(get_book(self.stock.id).best_bid())
+
+    def test_best_price_matches_before_older_worse_price(self):
+        sell_high = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                         price=101, quantity=10, remaining_quantity=10)
+        sell_low = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                        price=99, quantity=10, remaining_quantity=10)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=101, quantity=10, remaining_quantity=10)
+        match_orders(buy)
+
+        sell_high.refresh_from_db()
+        sell_low.refresh_from_db()
+        self.assertEqual(sell_low.status, Order.COMPLETED)
+        self.assertEqual(sell_high.status, Order.PENDING)
+        self.assertEqual(Trade.objects.get().price, Decimal("99.00"))
+
+    def test_settlement_in_ticks_matches_decimal_rounding(self):
+        UserHolding.objects.create(user=self.seller, stock=self.stock, quantity=10, avg_price=90)
+        for price, qty in ((Decimal("100.01"), 1), (Decimal("100.02"), 2), (Decimal("100.01"), 3)):
+            sell = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                        price=price, quantity=qty, remaining_quantity=qty)
+            match_orders(sell)
+            buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                       price=price, quantity=qty, remaining_quantity=qty)
+            match_orders(buy)
+        holding = UserHolding.objects.get(user=self.buyer, stock=self.stock)
+        # 100.01, then 300.05 / 3 = 100.0167 -> 100.02, then 600.09 / 6 = 100.015, a tie rounded to even.
+        self.assertEqual((holding.quantity, holding.avg_price), (6, Decimal("100.02")))
+        self.buyer.refresh_from_db()
+        self.assertEqual(self.buyer.balance, Decimal("100000.00") - Decimal("600.08"))
+        seller_holding = UserHolding.objects.get(user=self.seller, stock=self.stock)
+        self.assertEqual(seller_holding.realized_pnl, Decimal("60.08"))
+
+    def test_unfilled_remainder_rests_in_book(self):
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=10, remaining_quantity=10)
+        match_orders(buy)
+        book = get_book(self.stock.id)
+        self.assertIn(buy.id, book)
+        self.assertEqual(book.best_bid(), 100)
+
+        sell = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                    price=100, quantity=4, remaining_quantity=4)
+        with self.assertNumQueries(0):
+            self.assertEqual(book.best_order(Order.BUY).id, buy.id)
+        match_orders(sell)
+        self.assertEqual(book.best_order(Order.BUY).remaining_quantity, 6)
+        self.assertNotIn(sell.id, book)
+
+
+    def test_stock_price_and_session_stats_follow_trades(self):
+        for price, qty in ((100, 10), (102, 30)):
+            Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                 price=price, quantity=qty, remaining_quantity=qty)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=102, quantity=40, remaining_quantity=40)
+        get_book(self.stock.id)
+        with CaptureQueriesContext(connection) as queries:
+            match_orders(buy)
+        stock_updates = [q for q in queries if q["sql"].startswith('UPDATE "stock_app_stock"')]
+        self.assertEqual(len(stock_updates), 1)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.current_price, Decimal("102.00"))
+        self.assertEqual(self.stock.session_high, Decimal("102.00"))
+        self.assertEqual(self.stock.session_low, Decimal("100.00"))
+        self.assertEqual(self.stock.session_volume, 40)
+        self.assertEqual(self.stock.vwap, Decimal("101.5000"))
+
+    def sweep_queries(self, resting):
+        sellers = [
+            User.objects.create_user(username=f"s{resting}-{i}", email=f"s{resting}-{i}@example.com", password="pass")
+            for i in range(resting)
+        ]
+        # Closed positions keep their row, so start the buyer with one too.
+        UserHolding.objects.get_or_create(user=self.buyer, stock=self.stock, defaults={"quantity": 0, "avg_price": 0})
+        for seller in sellers:
+            UserHolding.objects.create(user=seller, stock=self.stock, quantity=10, avg_price=90)
+            Order.objects.create(user=seller, stock=self.stock, order_type=Order.SELL,
+                                 price=100, quantity=10, remaining_quantity=10)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=10 * resting, remaining_quantity=10 * resting)
+        # Only the per-pass cost is compared, not loading the book's state.
+        get_book(self.stock.id).candles = CandleAggregator(self.stock.id)
+        with CaptureQueriesContext(connection) as queries:
+            match_orders(buy)
+        self.assertEqual(buy.status, Order.COMPLETED)
+        self.assertFalse(UserHolding.objects.filter(user__in=sellers, quantity__gt=0).exists())
+        return len(queries)
+
+    @skipUnless(connection.features.has_select_for_update, "row locks need a backend that has them")
+    def test_settlement_locks_user_rows_in_id_order(self):
+        sell = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                    price=100, quantity=5, remaining_quantity=5)
+        match_orders(sell)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=5, remaining_quantity=5)
+        with CaptureQueriesContext(connection) as queries:
+            match_orders(buy)
+        locks = [q["sql"] for q in queries if q["sql"].endswith("FOR UPDATE")]
+        self.assertEqual(len(locks), 1)
+        self.assertIn('FROM "stock_app_user"', locks[0])
+
+    def test_settlement_query_count_does_not_grow_with_fills(self):
+        few = self.sweep_queries(2)
+        reset_books()
+        accounts.clear()
+        Order.objects.update(status=Order.COMPLETED, remaining_quantity=0)
+        many = self.sweep_queries(20)
+        self.assertEqual(few, many)
+        holding = UserHolding.objects.get(user=self.buyer, stock=self.stock)
+        self.assertEqual(holding.quantity, 220)
+        self.assertEqual(Trade.objects.count(), 22)
+
+class OrderBookTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="maker", email="maker@example.com", password="pass")
+        self.stock = Stock.objects.create(name="INFY", current_price=100)
+        self.book = OrderBook(self.stock.id)
+
+    def order(self, order_type, price, qty=1):
+        return Order.objects.create(user=self.user, stock=self.stock, order_type=order_type,
+                                    price=price, quantity=qty, remaining_quantity=qty)
+
+    def test_best_bid_and_ask(self):
+        for price in (98, 100, 99):
+            self.book.add(self.order(Order.BUY, price))
+        for price in (103, 101, 102):
+            self.book.add(self.order(Order.SELL, price))
+        self.assertEqual(self.book.best_bid(), 100)
+        self.assertEqual(self.book.best_ask(), 101)
+
+    def test_fifo_within_level_and_remove(self):
+        first = self.order(Order.SELL, 100)
+        second = self.order(Order.SELL, 100)
+        third = self.order(Order.SELL, 100)
+        for order in (first, second, third):
+            self.book.add(order)
+
+        self.assertEqual(self.book.remove(second.id).id, second.id)
+        self.assertIsNone(self.book.remove(second.id))
+        self.assertEqual(self.book.fill_best(Order.SELL, 1).id, first.id)
+        self.assertEqual(self.book.fill_best(Order.SELL, 1).id, third.id)
+        self.assertIsNone(self.book.best_ask())
+        self.assertEqual(len(self.book), 0)
+
+    def test_resting_orders_are_compact_records_in_ticks(self):
+        record = self.book.add(self.order(Order.SELL, Decimal("100.25")))
+        self.assertIsInstance(record, BookOrder)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record.ticks, 10025)
+        self.assertEqual(self.book.best_ask(), Decimal("100.25"))
+        self.assertEqual(self.book.depth(Order.SELL, 1), [(Decimal("100.25"), 1, 1)])
+
+
+@override_settings(MATCHING_SHARDS=0)
+class OrderApiTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        self.buyer = User.objects.create_user(username="apibuyer", email="apibuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="apiseller", email="apiseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="TCS", current_price=100)
+        UserHolding.objects.create(user=self.seller, stock=self.stock, quantity=50, avg_price=90)
+        self.client = APIClient()
+
+    def place(self, user, order_type, price, quantity):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/orders/", {
+            "stock": self.stock.id, "order_type": order_type, "price": price, "quantity": quantity,
+        }, format="json")
+
+    def test_order_is_matched_before_responding(self):
+        self.assertEqual(self.place(self.seller, Order.SELL, "100.00", 10).status_code, 201)
+        response = self.place(self.buyer, Order.BUY, "100.00", 10)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["status"], Order.COMPLETED)
+        self.assertEqual(response.data["remaining_quantity"], 0)
+
+
+    def test_order_history_is_cursor_paginated_without_count(self):
+        for _ in range(25):
+            Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                 price=1, quantity=1, remaining_quantity=1)
+        self.client.force_authenticate(self.buyer)
+        seen = []
+        url = "/api/orders/?page_size=10"
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                page = self.client.get(url).data
+                self.assertNotIn("count", page)
+                seen.extend(order["id"] for order in page["results"])
+                url = page["next"]
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries))
+
+    def test_trade_ledger_lists_both_sides_in_one_query(self):
+        for _ in range(3):
+            self.place(self.seller, Order.SELL, "100.00", 2)
+            self.place(self.buyer, Order.BUY, "100.00", 2)
+        trade = Trade.objects.first()
+        self.assertEqual((trade.buyer, trade.seller), (self.buyer, self.seller))
+        for user in (self.buyer, self.seller):
+            self.client.force_authenticate(user)
+            with self.assertNumQueries(1):
+                response = self.client.get("/api/trades/")
+            self.assertEqual(len(response.data["results"]), 3)
+
+    def bulk(self, user, body, content_type):
+        self.client.force_authenticate(user)
+        response = self.client.post("/api/orders/bulk/", body, content_type=content_type)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+    def test_bulk_orders_stream_results_in_order(self):
+        sells = [
+            {"stock": self.stock.id, "order_type": Order.SELL, "price": "100.00", "quantity": 20},
+            {"stock": self.stock.id, "order_type": Order.SELL, "price": "101.00", "quantity": 20},
+            # Only 10 shares left after the first two.
+            {"stock": self.stock.id, "order_type": Order.SELL, "price": "102.00", "quantity": 20},
+        ]
+        body = "\n".join(json.dumps(order) for order in sells)
+        results = self.bulk(self.seller, body, "application/x-ndjson")
+        self.assertEqual([result["status"] for result in results], [201, 201, 400])
+        self.assertIn("Insufficient shares", str(results[2]["errors"]))
+
+        buys = [{"stock": self.stock.id, "order_type": Order.BUY, "price": "101.00", "quantity": 15}] * 2
+        results = self.bulk(self.buyer, json.dumps(buys), "application/json")
+        self.assertEqual([result["order"]["status"] for result in results], [Order.COMPLETED, Order.COMPLETED])
+        self.assertEqual(Trade.objects.count(), 3)
+
+    def test_bulk_validation_fetches_account_once(self):
+        buys = [{"stock": self.stock.id, "order_type": Order.BUY, "price": "1.00", "quantity": 1}] * 50
+        self.client.force_authenticate(self.buyer)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post("/api/orders/bulk/", buys, format="json")
+        holding_queries = [q for q in queries if "stock_app_userholding" in q["sql"]]
+        stock_queries = [q for q in queries if q["sql"].startswith('SELECT "stock_app_stock"')]
+        self.assertEqual(len(holding_queries), 1)
+        # One prefetch for the batch, one when the matcher loads the book.
+        self.assertEqual(len(stock_queries), 2)
+        self.assertEqual(Order.objects.filter(user=self.buyer).count(), 50)
+
+    def test_book_snapshot_tracks_depth_and_last_trade(self):
+        reset_stock_index()
+        for price, quantity in (("101.00", 5), ("101.00", 7), ("102.00", 3)):
+            self.place(self.seller, Order.SELL, price, quantity)
+        self.place(self.buyer, Order.BUY, "99.00", 4)
+        self.place(self.buyer, Order.BUY, "101.00", 6)
+
+        self.client.force_authenticate(self.buyer)
+        get_stock_index()
+        with self.assertNumQueries(0):
+            book = self.client.get(f"/api/stocks/{self.stock.id}/book/?depth=1").data
+        self.assertEqual(book["best_bid"], "99.00")
+        self.assertEqual(book["best_ask"], "101.00")
+        self.assertEqual(book["asks"], [{"price": "101.00", "quantity": 6, "orders": 1}])
+        self.assertEqual(book["bids"], [{"price": "99.00", "quantity": 4, "orders": 1}])
+        self.assertEqual(book["last_trade"]["price"], "101.00")
+        self.assertEqual(book["last_trade"]["quantity"], 1)
+        self.assertEqual(self.client.get("/api/stocks/999/book/").status_code, 404)
+
+    def test_cancel_removes_order_from_book(self):
+        first = self.place(self.seller, Order.SELL, "101.00", 5).data["id"]
+        second = self.place(self.seller, Order.SELL, "101.00", 3).data["id"]
+        response = self.client.delete(f"/api/orders/{first}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], Order.CANCELLED)
+        self.assertEqual(response.data["remaining_quantity"], 5)
+        self.assertEqual([order.id for order in get_book(self.stock.id).orders()], [second])
+        self.assertEqual(self.client.delete(f"/api/orders/{first}/").status_code, 409)
+
+        self.place(self.buyer, Order.BUY, "101.00", 5)
+        self.assertEqual(Order.objects.get(pk=second).status, Order.COMPLETED)
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.client.delete(f"/api/orders/{second}/").status_code, 404)
+
+    def test_amend_priority_rules(self):
+        first = self.place(self.seller, Order.SELL, "101.00", 5).data["id"]
+        second = self.place(self.seller, Order.SELL, "101.00", 5).data["id"]
+
+        # Reducing quantity keeps the order at the front of its queue.
+        response = self.client.patch(f"/api/orders/{first}/", {"quantity": 2}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["quantity"], response.data["remaining_quantity"]), (2, 2))
+        book = get_book(self.stock.id)
+        self.assertEqual([order.id for order in book.orders()], [first, second])
+        self.assertEqual(book.depth(Order.SELL, 1), [(Decimal("101.00"), 7, 2)])
+
+        # Raising it sends the order to the back.
+        self.client.patch(f"/api/orders/{first}/", {"quantity": 4}, format="json")
+        self.assertEqual([order.id for order in book.orders()], [second, first])
+
+        # A new price that crosses trades straight away.
+        self.place(self.buyer, Order.BUY, "99.00", 3)
+        self.client.force_authenticate(self.seller)
+        response = self.client.patch(f"/api/orders/{second}/", {"price": "99.00"}, format="json")
+        self.assertEqual(response.data["status"], Order.PARTIAL)
+        self.assertEqual(response.data["remaining_quantity"], 2)
+        self.assertEqual(Trade.objects.get().price, Decimal("99.00"))
+
+        response = self.client.patch(f"/api/orders/{second}/", {"quantity": 3}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("already filled", str(response.data))
+
+    def test_amendment_beyond_available_cash_conflicts(self):
+        bid = self.place(self.buyer, Order.BUY, "99.00", 10).data["id"]
+        response = self.client.patch(f"/api/orders/{bid}/", {"price": "20000.00"}, format="json")
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("Insufficient balance", response.data["error"])
+        self.assertEqual(Order.objects.get(pk=bid).price, Decimal("99.00"))
+
+    def test_only_open_limit_orders_can_be_amended(self):
+        done = self.post(self.buyer, order_type=Order.BUY, kind=Order.MARKET, quantity=5).data["id"]
+        response = self.client.patch(f"/api/orders/{done}/", {"quantity": 9}, format="json")
+        self.assertEqual(response.status_code, 409)
+        # Accepted but not matched yet.
+        pending = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY, kind=Order.MARKET,
+                                       time_in_force=Order.IOC, quantity=5, remaining_quantity=5)
+        response = self.client.patch(f"/api/orders/{pending.id}/", {"quantity": 9}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Market orders", str(response.data))
+
+    def post(self, user, **body):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/orders/", dict(body, stock=self.stock.id), format="json")
+
+    def test_ioc_remainder_is_cancelled(self):
+        self.place(self.seller, Order.SELL, "100.00", 5)
+        response = self.post(self.buyer, order_type=Order.BUY, price="100.00", quantity=8, time_in_force=Order.IOC)
+        self.assertEqual((response.data["status"], response.data["remaining_quantity"]), (Order.CANCELLED, 3))
+        self.assertEqual(Trade.objects.get().quantity, 5)
+        self.assertIsNone(get_book(self.stock.id).best_bid())
+
+    def test_fok_fills_completely_or_not_at_all(self):
+        self.place(self.seller, Order.SELL, "100.00", 5)
+        self.place(self.seller, Order.SELL, "101.00", 2)
+        response = self.post(self.buyer, order_type=Order.BUY, price="101.00", quantity=8, time_in_force=Order.FOK)
+        self.assertEqual((response.data["status"], response.data["remaining_quantity"]), (Order.CANCELLED, 8))
+        self.assertFalse(Trade.objects.exists())
+        self.assertEqual(get_book(self.stock.id).depth(Order.SELL, 5), [
+            (Decimal("100.00"), 5, 1), (Decimal("101.00"), 2, 1),
+        ])
+        response = self.post(self.buyer, order_type=Order.BUY, price="101.00", quantity=7, time_in_force=Order.FOK)
+        self.assertEqual(response.data["status"], Order.COMPLETED)
+
+    def test_fok_counts_only_what_can_trade(self):
+        self.place(self.seller, Order.SELL, "100.00", 5)
+        # Due to expire but not swept yet: not there to fill the order.
+        dated = self.post(self.seller, order_type=Order.SELL, price="101.00", quantity=5, time_in_force=Order.GTD,
+                          expires_at=(timezone.now() + timedelta(hours=1)).isoformat()).data["id"]
+        get_book(self.stock.id).get(dated).expires_at = timezone.now()
+        response = self.post(self.buyer, order_type=Order.BUY, price="101.00", quantity=8, time_in_force=Order.FOK)
+        self.assertEqual((response.data["status"], response.data["remaining_quantity"]), (Order.CANCELLED, 8))
+        self.assertFalse(Trade.objects.exists())
+
+        # A market buy can only take what the buyer's cash covers.
+        User.objects.filter(pk=self.buyer.pk).update(balance=Decimal("250.00"))
+        accounts.forget([self.buyer.id])
+        response = self.post(self.buyer, order_type=Order.BUY, kind=Order.MARKET, quantity=5,
+                             time_in_force=Order.FOK)
+        self.assertEqual((response.data["status"], response.data["remaining_quantity"]), (Order.CANCELLED, 5))
+        self.assertFalse(Trade.objects.exists())
+
+    def test_market_order_on_unloaded_book(self):
+        Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                             price=100, quantity=5, remaining_quantity=5)
+        reset_books()
+        response = self.post(self.seller, order_type=Order.SELL, kind=Order.MARKET, quantity=5)
+        self.assertEqual((response.status_code, response.data["status"]), (201, Order.COMPLETED))
+        self.assertEqual(Trade.objects.get().quantity, 5)
+        self.assertEqual(self.client.get(f"/api/stocks/{self.stock.id}/book/").status_code, 200)
+
+    def test_market_order_takes_best_prices(self):
+        self.place(self.seller, Order.SELL, "100.00", 3)
+        self.place(self.seller, Order.SELL, "105.00", 3)
+        response = self.post(self.buyer, order_type=Order.BUY, kind=Order.MARKET, quantity=5)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["time_in_force"], Order.IOC)
+        self.assertEqual(response.data["status"], Order.COMPLETED)
+        self.assertEqual(
+            list(Trade.objects.order_by("id").values_list("price", "quantity")),
+            [(Decimal("100.00"), 3), (Decimal("105.00"), 2)],
+        )
+        response = self.post(self.buyer, order_type=Order.BUY, kind=Order.MARKET, quantity=5, price="1.00")
+        self.assertEqual(response.status_code, 400)
+        response = self.post(self.buyer, order_type=Order.BUY, kind=Order.MARKET, quantity=5, time_in_force=Order.GTC)
+        self.assertEqual(response.status_code, 400)
+
+    def test_gtd_orders_expire(self):
+        sweeper.clear()
+        expires_at = timezone.now() + timedelta(hours=1)
+        swept = self.post(self.seller, order_type=Order.SELL, price="100.00", quantity=5,
+                          time_in_force=Order.GTD, expires_at=expires_at.isoformat()).data["id"]
+        lazy = self.post(self.seller, order_type=Order.SELL, price="101.00", quantity=5, time_in_force=Order.GTD,
+                         expires_at=(expires_at + timedelta(hours=1)).isoformat()).data["id"]
+        self.assertEqual(self.post(self.seller, order_type=Order.SELL, price="101.00", quantity=5).status_code, 201)
+
+        sweeper.run_due(timezone.now() + timedelta(minutes=30))
+        self.assertEqual(Order.objects.get(pk=swept).status, Order.PENDING)
+        sweeper.run_due(expires_at)
+        self.assertEqual(Order.objects.get(pk=swept).status, Order.EXPIRED)
+
+        # Due but not yet swept: skipped by the matcher, never traded.
+        get_book(self.stock.id).get(lazy).expires_at = timezone.now()
+        response = self.post(self.buyer, order_type=Order.BUY, price="101.00", quantity=5)
+        self.assertEqual(response.data["status"], Order.COMPLETED)
+        self.assertEqual(Order.objects.get(pk=lazy).status, Order.EXPIRED)
+        self.assertEqual(len(get_book(self.stock.id)), 0)
+
+@override_settings(MATCHING_SHARDS=0)
+class RiskTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        self.buyer = User.objects.create_user(username="riskbuyer", email="riskbuyer@example.com",
+                                              password="pass", balance=Decimal("1000.00"))
+        self.seller = User.objects.create_user(username="riskseller", email="riskseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="WIPRO", current_price=100)
+        UserHolding.objects.create(user=self.seller, stock=self.stock, quantity=10, avg_price=90)
+        self.client = APIClient()
+
+    def place(self, user, order_type, price, quantity):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/orders/", {
+            "stock": self.stock.id, "order_type": order_type, "price": price, "quantity": quantity,
+        }, format="json")
+
+    def test_open_buys_reserve_cash(self):
+        self.assertEqual(self.place(self.buyer, Order.BUY, "100.00", 6).status_code, 201)
+        response = self.place(self.buyer, Order.BUY, "100.00", 5)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Available: 400.00", str(response.data))
+        self.assertEqual(self.place(self.buyer, Order.BUY, "100.00", 4).status_code, 201)
+
+        order = Order.objects.filter(user=self.buyer).first()
+        cancel_order(order)
+        self.assertEqual(accounts.get(self.buyer.id).available_cash, Decimal("600.00"))
+
+    def test_open_sells_reserve_shares(self):
+        self.assertEqual(self.place(self.seller, Order.SELL, "100.00", 8).status_code, 201)
+        response = self.place(self.seller, Order.SELL, "100.00", 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("only 2 shares", str(response.data))
+
+    def test_reservations_are_rebuilt_from_open_orders(self):
+        self.place(self.buyer, Order.BUY, "99.00", 5)
+        self.place(self.seller, Order.SELL, "101.00", 4)
+        accounts.clear()
+        self.assertEqual(accounts.get(self.buyer.id).reserved_cash, Decimal("495.00"))
+        self.assertEqual(accounts.get(self.seller.id).reserved_shares, {self.stock.id: 4})
+
+    def test_fills_keep_accounts_in_step(self):
+        self.place(self.seller, Order.SELL, "95.00", 4)
+        self.place(self.buyer, Order.BUY, "100.00", 6)
+        buyer, seller = accounts.get(self.buyer.id), accounts.get(self.seller.id)
+        self.assertEqual(buyer.balance, Decimal("620.00"))
+        self.assertEqual(buyer.reserved_cash, Decimal("200.00"))
+        self.assertEqual(buyer.shares, {self.stock.id: 4})
+        self.assertEqual((seller.shares, seller.reserved_shares), ({self.stock.id: 6}, {self.stock.id: 0}))
+
+        accounts.clear()
+        self.assertEqual(accounts.get(self.buyer.id).balance, Decimal("620.00"))
+        self.assertEqual(accounts.get(self.buyer.id).reserved_cash, Decimal("200.00"))
+
+    def test_checks_do_not_query_once_loaded(self):
+        accounts.get(self.buyer.id)
+        request = APIRequestFactory().post("/api/orders/")
+        request.user = self.buyer
+        data = {"stock": self.stock.id, "order_type": Order.BUY, "price": "100.00", "quantity": 2}
+        serializer = OrderSerializer(
+            data=data, context={"request": request, "stocks": {self.stock.id: self.stock}}
+        )
+        with self.assertNumQueries(0):
+            self.assertTrue(serializer.is_valid())
+            # Validating alone reserves nothing; saving does.
+            self.assertEqual(accounts.get(self.buyer.id).reserved_cash, 0)
+            reserve_order(Order(user=self.buyer, remaining_quantity=2, **serializer.validated_data))
+        self.assertEqual(accounts.get(self.buyer.id).reserved_cash, Decimal("200.00"))
+
+
+@override_settings(MATCHING_SHARDS=0)
+class PortfolioTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        responses.clear()
+        portfolios.clear()
+        self.buyer = User.objects.create_user(username="pfbuyer", email="pfbuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="pfseller", email="pfseller@example.com", password="pass")
+        self.tcs = Stock.objects.create(name="TCS", current_price=100)
+        self.infy = Stock.objects.create(name="INFY", current_price=50)
+        UserHolding.objects.create(user=self.seller, stock=self.tcs, quantity=10, avg_price=90)
+        UserHolding.objects.create(user=self.seller, stock=self.infy, quantity=20, avg_price=60)
+        self.client = APIClient()
+
+    def get_portfolio(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get("/api/portfolio/")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_values_holdings_at_last_price(self):
+        data = self.get_portfolio(self.seller)
+        tcs, infy = data["holdings"]
+        self.assertEqual((tcs["market_value"], tcs["unrealized_pnl"], tcs["allocation"]), ("1000.00", "100.00", "50.00"))
+        self.assertEqual((infy["market_value"], infy["unrealized_pnl"]), ("1000.00", "-200.00"))
+        self.assertEqual(data["totals"], {
+            "market_value": "2000.00", "cost_basis": "2100.00", "unrealized_pnl": "-100.00", "realized_pnl": "0.00",
+        })
+
+    def test_fills_realize_pnl_and_invalidate(self):
+        self.get_portfolio(self.seller)
+        for user, side in ((self.seller, Order.SELL), (self.buyer, Order.BUY)):
+            self.client.force_authenticate(user)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post("/api/orders/", {
+                    "stock": self.tcs.id, "order_type": side, "price": "110.00", "quantity": 10,
+                }, format="json")
+
+        tcs = self.get_portfolio(self.seller)["holdings"][0]
+        self.assertEqual((tcs["quantity"], tcs["market_value"], tcs["realized_pnl"]), (0, "0.00", "200.00"))
+        self.assertEqual(self.get_portfolio(self.buyer)["holdings"][0]["market_value"], "1100.00")
+        self.client.force_authenticate(self.seller)
+        self.assertEqual(len(self.client.get("/api/holdings/").data["results"]), 1)
+
+    def test_cached_until_a_price_changes(self):
+        self.get_portfolio(self.seller)
+        with self.assertNumQueries(0):
+            self.get_portfolio(self.seller)
+        self.infy.current_price = 70
+        with self.captureOnCommitCallbacks(execute=True):
+            self.infy.save()
+        self.assertEqual(self.get_portfolio(self.seller)["holdings"][1]["unrealized_pnl"], "200.00")
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        responses.clear()
+        self.user = User.objects.create_user(username="etag", email="etag@example.com", password="pass")
+        self.other = User.objects.create_user(username="etag2", email="etag2@example.com", password="pass")
+        self.stock = Stock.objects.create(name="WIPRO", current_price=100)
+        UserHolding.objects.create(user=self.other, stock=self.stock, quantity=10, avg_price=90)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_unchanged_list_is_not_modified(self):
+        first = self.client.get("/api/stocks/")
+        self.assertEqual(first.status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/stocks/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/stocks/")
+        self.assertEqual((response.status_code, response["ETag"]), (200, first["ETag"]))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/stocks/", HTTP_CACHE_CONTROL="no-cache")
+        self.assertTrue(queries)
+        self.assertEqual(response["ETag"], first["ETag"])
+
+    def test_price_change_invalidates_stock_list(self):
+        etag = self.client.get("/api/stocks/")["ETag"]
+        self.stock.current_price = 120
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stock.save()
+        response = self.client.get("/api/stocks/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.data["results"][0]["current_price"], "120.00")
+
+    @override_settings(MATCHING_SHARDS=0)
+    def test_fill_invalidates_both_users_lists(self):
+        orders_etag = self.client.get("/api/orders/")["ETag"]
+        holdings_etag = self.client.get("/api/holdings/")["ETag"]
+        self.client.force_authenticate(self.other)
+        seller_etag = self.client.get("/api/holdings/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/orders/", {
+                "stock": self.stock.id, "order_type": Order.SELL, "price": "100.00", "quantity": 4,
+            }, format="json")
+        self.client.force_authenticate(self.user)
+        # The other user's resting order changes nothing for this user.
+        self.assertEqual(self.client.get("/api/orders/", HTTP_IF_NONE_MATCH=orders_etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/orders/", {
+                "stock": self.stock.id, "order_type": Order.BUY, "price": "100.00", "quantity": 4,
+            }, format="json")
+
+        response = self.client.get("/api/orders/", HTTP_IF_NONE_MATCH=orders_etag)
+        self.assertEqual((response.status_code, response.data["results"][0]["status"]), (200, Order.COMPLETED))
+        response = self.client.get("/api/holdings/", HTTP_IF_NONE_MATCH=holdings_etag)
+        self.assertEqual((response.status_code, response.data["results"][0]["quantity"]), (200, 4))
+        self.client.force_authenticate(self.other)
+        response = self.client.get("/api/holdings/", HTTP_IF_NONE_MATCH=seller_etag)
+        self.assertEqual((response.status_code, response.data["results"][0]["quantity"]), (200, 6))
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        responses.clear()
+        pins.clear()
+        self.user = User.objects.create_user(username="reader", email="reader@example.com", password="pass")
+        self.other = User.objects.create_user(username="other", email="other@example.com", password="pass")
+        self.stock = Stock.objects.create(name="HDFC", current_price=100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(READ_REPLICAS={"ALIASES": ["replica1", "replica2"]})
+    def test_list_reads_use_replicas_in_turn(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Stock))
+        used = set()
+        for _ in range(2):
+            with replica_reads(self.user.id) as alias:
+                self.assertEqual(router.db_for_read(Stock), alias)
+                with primary_reads():
+                    self.assertIsNone(router.db_for_read(Stock))
+            used.add(alias)
+        self.assertEqual(used, {"replica1", "replica2"})
+        self.assertEqual(router.db_for_write(Stock), "default")
+        self.assertFalse(router.allow_migrate("replica1", "stock_app"))
+
+    # The primary stands in for the replica so the views really run.
+    @override_settings(READ_REPLICAS={"ALIASES": ["default"]}, MATCHING_SHARDS=0)
+    def test_user_reads_own_writes_from_primary(self):
+        response = self.client.post("/api/orders/", {
+            "stock": self.stock.id, "order_type": Order.BUY, "price": "100.00", "quantity": 1,
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(pins.pinned(self.user.id))
+        self.assertFalse(pins.pinned(self.other.id))
+        with replica_reads(self.user.id) as alias:
+            self.assertIsNone(alias)
+        with replica_reads(self.other.id) as alias:
+            self.assertEqual(alias, "default")
+        self.assertEqual(len(self.client.get("/api/orders/").data["results"]), 1)
+
+    # replica1 isn't configured here, so reading from it would fail.
+    @override_settings(READ_REPLICAS={"ALIASES": ["replica1"]})
+    def test_search_index_is_built_from_primary(self):
+        reset_stock_index()
+        with replica_reads(self.user.id) as alias:
+            self.assertEqual(alias, "replica1")
+            self.assertEqual(get_stock_index().get(self.stock.id)["name"], "HDFC")
+        response = self.client.get("/api/stocks/search/", {"q": "hd"})
+        self.assertEqual([stock["name"] for stock in response.data], ["HDFC"])
+
+    @override_settings(READ_REPLICAS={"ALIASES": ["default"], "STICKY_SECONDS": 0})
+    def test_pin_expires(self):
+        pins.pin(self.user.id)
+        self.assertFalse(pins.pinned(self.user.id))
+
+
+class SequencerTests(TransactionTestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        self.buyer = User.objects.create_user(username="seqbuyer", email="seqbuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="seqseller", email="seqseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="WIPRO", current_price=100)
+        self.sequencer = Sequencer(shards=2)
+
+    def tearDown(self):
+        self.sequencer.stop()
+
+    def test_same_stock_orders_match_in_submission_order(self):
+        sells = [
+            Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                 price=100, quantity=5, remaining_quantity=5)
+            for _ in range(3)
+        ]
+        futures = [self.sequencer.submit(sell) for sell in sells]
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=12, remaining_quantity=12)
+        futures.append(self.sequencer.submit(buy))
+        for future in futures:
+            future.result(timeout=10)
+
+        for sell in sells:
+            sell.refresh_from_db()
+        self.assertEqual([sell.remaining_quantity for sell in sells], [0, 0, 3])
+        self.assertEqual(buy.status, Order.COMPLETED)
+
+
+    def test_shard_keeps_its_connection_between_orders(self):
+        order = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                     price=100, quantity=1, remaining_quantity=1)
+        with mock.patch("stock_app.sequencer.close_old_connections") as close:
+            for _ in range(2):
+                self.sequencer.submit(order, lambda order: None).result(timeout=10)
+            with self.assertLogs("stock_app.sequencer", "ERROR"):
+                self.sequencer.submit(order, mock.Mock(side_effect=RuntimeError)).exception(timeout=10)
+        # Only the failure gives the connection up.
+        self.assertEqual(close.call_count, 1)
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class QueryPlanTests(TestCase):
+    """Guard the hot access paths against falling back to table scans."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="planner", email="planner@example.com", password="pass")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        for table in ("stock_app_order", "stock_app_trade", "stock_app_userholding"):
+            self.assertNotIn(f"SCAN {table}", plan)
+
+    def test_book_rebuild_uses_partial_open_orders_index(self):
+        self.assertUsesIndex(open_orders(1), "order_open_book_idx")
+
+    def test_order_history_uses_user_timestamp_index(self):
+        self.assertUsesIndex(Order.objects.filter(user=self.user).order_by("-timestamp"), "order_user_ts_idx")
+
+    def test_trade_history_avoids_trade_scan(self):
+        view = TradeListView()
+        view.request = type("Request", (), {"user": self.user})()
+        self.assertUsesIndex(view.get_queryset(), "trade_buyer_ts_idx")
+
+    def test_holdings_lookup_uses_user_stock_index(self):
+        self.assertUsesIndex(UserHolding.objects.filter(user=self.user, stock_id=1), "user_id_stock_id")
+
+
+class StockSearchTests(TestCase):
+    def setUp(self):
+        reset_stock_index()
+        self.user = User.objects.create_user(username="searcher", email="searcher@example.com", password="pass")
+        for name in ("Reliance Power", "RELIANCE", "Reliance Industries", "Infosys"):
+            Stock.objects.create(name=name, current_price=10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        return self.client.get("/api/stocks/search/", params)
+
+    def test_prefix_search_is_ranked_and_limited_without_queries(self):
+        get_stock_index()
+        with self.assertNumQueries(0):
+            response = self.search(q="rel", limit=2)
+        self.assertEqual([stock["name"] for stock in response.data], ["RELIANCE", "Reliance Power"])
+        self.assertEqual(self.search(q="reliance").data[0]["name"], "RELIANCE")
+        self.assertEqual(self.search(q="xyz").data, [])
+
+    def test_prefix_range_stops_at_its_neighbours(self):
+        for name in ("Rek", "Rel", "Relz", "Rem"):
+            Stock.objects.create(name=name, current_price=10)
+        names = {stock["name"] for stock in self.search(q="rel", limit=100).data}
+        self.assertEqual(names, {"Rel", "Relz", "RELIANCE", "Reliance Power", "Reliance Industries"})
+
+    def test_index_follows_created_and_deleted_stocks(self):
+        get_stock_index()
+        response = self.client.post("/api/stocks/", {"name": "Relaxo", "current_price": "5.00"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("Relaxo", [stock["name"] for stock in self.search(q="rela").data])
+        self.assertEqual(self.search(q=str(response.data["id"])).data[0]["name"], "Relaxo")
+
+        Stock.objects.filter(name="Relaxo").get().delete()
+        self.assertNotIn("Relaxo", [stock["name"] for stock in self.search(q="rela").data])
+
+
+class CandleTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        reset_stock_index()
+        self.buyer = User.objects.create_user(username="cbuyer", email="cbuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="cseller", email="cseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="HDFC", current_price=100)
+        self.t0 = timezone.make_aware(datetime(2026, 1, 5, 9, 15, 0))
+
+    def trade(self, price, quantity, seconds):
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=price, quantity=quantity, remaining_quantity=0, status=Order.COMPLETED)
+        sell = Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                                    price=price, quantity=quantity, remaining_quantity=0, status=Order.COMPLETED)
+        trade = Trade.objects.create(buy_order=buy, sell_order=sell, buyer=self.buyer, seller=self.seller,
+                                     stock=self.stock, price=price, quantity=quantity)
+        Trade.objects.filter(pk=trade.pk).update(timestamp=self.t0 + timedelta(seconds=seconds))
+
+    def test_buckets_align_to_local_midnight(self):
+        when = timezone.make_aware(datetime(2026, 1, 5, 10, 47, 31))
+        self.assertEqual(timezone.localtime(bucket_start(when, "5m")).time(), time(10, 45))
+        self.assertEqual(timezone.localtime(bucket_start(when, "1h")).time(), time(10, 0))
+        self.assertEqual(timezone.localtime(bucket_start(when, "1d")).time(), time(0, 0))
+
+    def test_aggregator_returns_finished_buckets(self):
+        aggregator = CandleAggregator(self.stock.id)
+        self.assertEqual(aggregator.add_trade(100, 5, self.t0), [])
+        finished = aggregator.add_trade(103, 1, self.t0 + timedelta(seconds=20))
+        self.assertEqual([candle.interval for candle in finished], ["1s"])
+        finished = aggregator.add_trade(99, 2, self.t0 + timedelta(seconds=61))
+        minute = [candle for candle in finished if candle.interval == "1m"][0]
+        self.assertEqual((minute.open, minute.high, minute.low, minute.close, minute.volume),
+                         (100, 103, 100, 103, 6))
+        self.assertEqual({candle.interval for candle in finished}, {"1s", "1m"})
+
+    def test_resume_finishes_buckets_left_open(self):
+        self.trade(100, 5, 0)
+        self.trade(102, 1, 10)
+        aggregator = CandleAggregator.resume(self.stock.id, now=self.t0 + timedelta(minutes=10))
+        self.assertEqual(set(aggregator.current), {"1h", "1d"})
+        self.assertEqual(aggregator.current["1h"].volume, 6)
+        self.assertEqual(
+            {c.interval: (c.open, c.high, c.close, c.volume) for c in Candle.objects.filter(stock=self.stock)},
+            {"1s": (102, 102, 102, 1), "1m": (100, 102, 102, 6), "5m": (100, 102, 102, 6)},
+        )
+
+    def test_backfill_command_and_endpoint(self):
+        for price, quantity, seconds in ((100, 5, 0), (104, 2, 30), (98, 1, 59), (101, 4, 75)):
+            self.trade(price, quantity, seconds)
+        call_command("backfill_candles", chunk_size=2, stdout=StringIO())
+
+        minutes = Candle.objects.filter(stock=self.stock, interval="1m").order_by("start")
+        self.assertEqual(
+            [(c.open, c.high, c.low, c.close, c.volume) for c in minutes],
+            [(100, 104, 98, 98, 8), (101, 101, 101, 101, 4)],
+        )
+        self.assertEqual(Candle.objects.get(stock=self.stock, interval="1d").volume, 12)
+
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        response = client.get(f"/api/stocks/{self.stock.id}/candles/?interval=1m")
+        self.assertEqual([candle["close"] for candle in response.data], ["98.00", "101.00"])
+        self.assertEqual(client.get(f"/api/stocks/{self.stock.id}/candles/?interval=2m").status_code, 400)
+
+    def test_matcher_keeps_open_candle_in_memory(self):
+        Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                             price=100, quantity=5, remaining_quantity=5)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=100, quantity=5, remaining_quantity=5)
+        match_orders(buy)
+        self.assertFalse(Candle.objects.exists())
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        response = client.get(f"/api/stocks/{self.stock.id}/candles/?interval=1d")
+        self.assertEqual(response.data[0]["volume"], 5)
+
+
+class BenchmarkTests(TestCase):
+    def test_scenarios_report_latency_and_queries(self):
+        for scenario in SCENARIOS:
+            bench = Benchmark(users=3, stocks=2, resting=20, orders=10, sweep_depth=5, seed=7)
+            User.objects.filter(username__startswith="bench").delete()
+            Stock.objects.filter(name__startswith="BENCH").delete()
+            bench.seed()
+            result = bench.run(scenario)
+            self.assertEqual(result["orders"], 10)
+            self.assertGreater(result["orders_per_sec"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p999_ms"])
+            self.assertGreater(result["queries_per_order"], 0)
+        # Every sweep was fully filled by the liquidity topped up for it.
+        self.assertFalse(Order.objects.filter(quantity=5, status__in=[Order.PENDING, Order.PARTIAL],
+                                              price__in=[50, 150]).exists())
+
+    def test_percentile_uses_nearest_rank(self):
+        values = list(range(1, 1001))
+        self.assertEqual(percentile(values, 0.5), 500)
+        self.assertEqual(percentile(values, 0.99), 990)
+        self.assertEqual(percentile(values, 0.999), 999)
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite pragmas")
+class SqlitePragmaTests(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_applied_to_connections(self):
+        self.assertEqual(self.pragma("busy_timeout"), settings.SQLITE_PRAGMAS["busy_timeout"])
+        self.assertEqual(self.pragma("cache_size"), settings.SQLITE_PRAGMAS["cache_size"])
+
+    def test_wal_pragmas_when_enabled(self):
+        other = connections.create_connection("default")
+        self.addCleanup(other.close)
+        with override_settings(SQLITE_PRAGMAS=settings.SQLITE_WAL_PRAGMAS):
+            other.ensure_connection()
+        with other.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+@override_settings(MATCHING_SHARDS=0)
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        instrumentation.registry.reset()
+        self.user = User.objects.create_user(username="probe", email="probe@example.com", password="pass")
+        self.stock = Stock.objects.create(name="ITC", current_price=100)
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def place_order(self):
+        return self.client.post("/api/orders/", {
+            "stock": self.stock.id, "order_type": Order.BUY, "price": "10.00", "quantity": 1,
+        }, format="json")
+
+    def test_disabled_instrumentation_records_nothing(self):
+        self.assertIs(instrumentation.span("anything"), instrumentation.span("else"))
+        self.place_order()
+        self.assertIsNone(instrumentation.registry.get((("span", "match_orders"),)))
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+    @override_settings(INSTRUMENTATION_ENABLED=True)
+    def test_stages_are_exported_as_prometheus_metrics(self):
+        self.assertEqual(self.place_order().status_code, 201)
+
+        auth = instrumentation.registry.get((("span", "auth"),))
+        self.assertEqual((auth.count, auth.queries), (1, 1))
+        self.assertEqual(instrumentation.registry.get((("span", "match_orders"),)).count, 1)
+        request = instrumentation.registry.get((("span", "request"), ("route", "api/orders/")))
+        self.assertGreater(request.queries, auth.queries)
+
+        metrics = self.client.get("/metrics").content.decode()
+        self.assertIn('stock_span_seconds_count{span="validate"} 1', metrics)
+        self.assertIn('stock_span_db_queries_total{span="auth"} 1', metrics)
+        self.assertIn('stock_span_seconds_bucket{span="request",route="api/orders/",le="+Inf"} 1', metrics)
+
+
+@override_settings(MATCHING_SHARDS=0)
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        responses.clear()
+        token_cache.clear()
+        self.user = User.objects.create_user(username="poller", email="poller@example.com", password="pass")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def test_repeat_requests_skip_the_token_lookup(self):
+        self.assertEqual(self.client.get("/api/trades/").status_code, 200)
+        with self.assertNumQueries(1):  # the trades page only
+            response = self.client.get("/api/trades/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_logout_revokes_cached_token(self):
+        self.client.get("/api/holdings/")
+        self.assertEqual(self.client.post("/api/logout/").status_code, 204)
+        self.assertEqual(self.client.get("/api/holdings/").status_code, 401)
+
+    def test_balance_changes_from_settlement_are_not_served_stale(self):
+        seller = User.objects.create_user(username="filler", email="filler@example.com", password="pass")
+        stock = Stock.objects.create(name="ONGC", current_price=10)
+        UserHolding.objects.create(user=seller, stock=stock, quantity=5, avg_price=10)
+        self.client.get("/api/holdings/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=seller, stock=stock, order_type=Order.SELL,
+                                 price=10, quantity=5, remaining_quantity=5)
+            response = self.client.post("/api/orders/", {
+                "stock": stock.id, "order_type": Order.BUY, "price": "10.00", "quantity": 5,
+            }, format="json")
+        self.assertEqual(response.data["status"], Order.COMPLETED)
+        response = self.client.get("/api/holdings/")
+        self.assertEqual(response.wsgi_request.user.balance, Decimal("99950.00"))
+
+
+@override_settings(MATCHING_SHARDS=0)
+class StreamingTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        token_cache.clear()
+        self.buyer = User.objects.create_user(username="streambuyer", email="streambuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="streamseller", email="streamseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="WIPRO", current_price=50)
+        UserHolding.objects.create(user=self.seller, stock=self.stock, quantity=10, avg_price=40)
+        self.token = Token.objects.create(user=self.buyer)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def subscribe(self, *topics, maxsize=None):
+        async def subscribe():
+            return broker.subscribe(topics, maxsize=maxsize)
+        subscription = self.loop.run_until_complete(subscribe())
+        self.addCleanup(subscription.close)
+        return subscription
+
+    def drain(self, subscription):
+        async def drain():
+            events = []
+            while True:
+                try:
+                    events.append(await subscription.get(timeout=0.05))
+                except asyncio.TimeoutError:
+                    return events
+        return self.loop.run_until_complete(drain())
+
+    def test_matching_publishes_events_after_commit(self):
+        buyer_events = self.subscribe(user_topic(self.buyer.id))
+        stock_events = self.subscribe(stock_topic(self.stock.id))
+        Order.objects.create(user=self.seller, stock=self.stock, order_type=Order.SELL,
+                             price=50, quantity=10, remaining_quantity=10)
+        buy = Order.objects.create(user=self.buyer, stock=self.stock, order_type=Order.BUY,
+                                   price=50, quantity=4, remaining_quantity=4)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            match_orders(buy)
+        self.assertEqual(self.drain(buyer_events), [])
+        for callback in callbacks:
+            callback()
+
+        events = self.drain(buyer_events)
+        self.assertEqual([event["type"] for event in events], ["fill", "order"])
+        self.assertEqual(events[0]["quantity"], 4)
+        self.assertEqual(events[1]["status"], Order.COMPLETED)
+        trade, book = self.drain(stock_events)
+        self.assertEqual((trade["type"], trade["price"], trade["quantity"]), ("trade", "50.00", 4))
+        self.assertEqual(book["type"], "book")
+        self.assertEqual(book["asks"], [{"price": "50.00", "quantity": 6, "orders": 1}])
+
+    def test_slow_subscriber_is_dropped(self):
+        subscription = self.subscribe(stock_topic(self.stock.id), maxsize=2)
+        for i in range(5):
+            broker.publish(stock_topic(self.stock.id), {"type": "trade", "n": i})
+        self.assertEqual(self.drain(subscription), [{"type": "trade", "n": 1}, None])
+        self.assertFalse(broker.has_subscribers(stock_topic(self.stock.id)))
+
+    async def test_async_order_entry(self):
+        await sync_to_async(Order.objects.create)(
+            user=self.seller, stock=self.stock, order_type=Order.SELL,
+            price=50, quantity=10, remaining_quantity=10,
+        )
+        client = AsyncClient()
+        body = {"stock": self.stock.id, "order_type": Order.BUY, "price": "50.00", "quantity": 2}
+        response = await client.post("/api/async/orders/", body, content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+
+        response = await client.post("/api/async/orders/", body, content_type="application/json",
+                                     headers={"Authorization": f"Token {self.token.key}"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["status"], Order.COMPLETED)
+
+    async def test_async_order_entry_releases_reservation_on_failure(self):
+        body = {"stock": self.stock.id, "order_type": Order.BUY, "price": "50.00", "quantity": 2}
+        with mock.patch.object(Order, "save", side_effect=DatabaseError("disk full")):
+            response = await AsyncClient().post("/api/async/orders/", body, content_type="application/json",
+                                                headers={"Authorization": f"Token {self.token.key}"})
+        self.assertEqual(response.status_code, 500)
+        account = await sync_to_async(accounts.get)(self.buyer.id)
+        self.assertEqual(account.available_cash, Decimal("100000.00"))
+
+    async def test_event_stream(self):
+        client = AsyncClient()
+        response = await client.get(f"/api/stream/?stocks={self.stock.id}",
+                                    headers={"Authorization": f"Token {self.token.key}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(broker.has_subscribers(stock_topic(self.stock.id)))
+        content = aiter(response.streaming_content)
+        self.assertEqual(await anext(content), b": connected\n\n")
+
+        broker.publish(stock_topic(self.stock.id), {"type": "trade", "price": "50.00"})
+        self.assertEqual(await anext(content), b'event: trade\ndata: {"type": "trade", "price": "50.00"}\n\n')
+
+
+class JournalTests(TestCase):
+    def setUp(self):
+        reset_books()
+        accounts.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings_override = override_settings(
+            MATCHING_JOURNAL={"DIR": directory, "FSYNC_INTERVAL": 0.01, "SNAPSHOT_EVERY": 10 ** 6}
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.directory = directory
+        self.buyer = User.objects.create_user(username="jbuyer", email="jbuyer@example.com", password="pass")
+        self.seller = User.objects.create_user(username="jseller", email="jseller@example.com", password="pass")
+        self.stock = Stock.objects.create(name="HDFC", current_price=100)
+        UserHolding.objects.create(user=self.seller, stock=self.stock, quantity=100, avg_price=90)
+
+    def place(self, user, order_type, price, qty):
+        order = Order.objects.create(user=user, stock=self.stock, order_type=order_type,
+                                     price=price, quantity=qty, remaining_quantity=qty)
+        match_orders(order)
+        return order
+
+    def trade(self):
+        self.place(self.seller, Order.SELL, 101, 5)
+        self.place(self.seller, Order.SELL, 102, 5)
+        self.place(self.buyer, Order.BUY, 99, 3)
+        self.place(self.buyer, Order.BUY, 101, 7)  # fills 5 @101, rests 2
+
+    def resting(self):
+        return [(o.id, o.remaining_quantity, o.status) for o in get_book(self.stock.id).orders()]
+
+    def restart(self):
+        reset_journal()
+        reset_books()
+        accounts.clear()
+        return get_journal()
+
+    def test_books_are_rebuilt_from_the_journal(self):
+        self.trade()
+        before = self.resting()
+        self.restart()
+        with self.assertNumQueries(2):  # stock stats and last trade; no open-order scan
+            get_book(self.stock.id)
+        self.assertEqual(self.resting(), before)
+        self.assertEqual(len(before), 3)
+
+    def test_book_endpoint_recovers_from_the_journal(self):
+        self.trade()
+        before = self.resting()
+        reset_journal()
+        reset_books()
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(f"/api/stocks/{self.stock.id}/book/")
+        self.assertEqual(response.status_code, 200)
+        # No open-order scan: the book came from the journal.
+        self.assertFalse([q for q in queries if 'FROM "stock_app_order"' in q["sql"] and "ORDER BY" in q["sql"]])
+        self.assertEqual(self.resting(), before)
+
+    def test_snapshot_replaces_earlier_segments(self):
+        self.trade()
+        get_journal().snapshot()
+        self.place(self.seller, Order.SELL, 101, 1)  # fills 1 of the resting bid
+        before = self.resting()
+        segments = [name for name in os.listdir(self.directory) if name.startswith("journal-")]
+        self.assertEqual(len(segments), 1)
+
+        self.restart()
+        self.assertEqual(self.resting(), before)
+
+    def test_cancels_and_amendments_are_replayed(self):
+        self.trade()
+        bid = Order.objects.get(stock=self.stock, price=99)
+        ask = Order.objects.get(stock=self.stock, price=102)
+        cancel_order(bid)
+        amend_order(ask, quantity=4)
+        before = self.resting()
+        self.restart()
+        self.assertEqual(self.resting(), before)
+        self.assertEqual(get_book(self.stock.id).depth(Order.SELL, 1), [(Decimal("102.00"), 4, 1)])
+
+    def test_book_that_disagrees_with_the_database_is_reloaded(self):
+        self.trade()
+        Order.objects.filter(stock=self.stock, price=99).update(status=Order.COMPLETED, remaining_quantity=0)
+        with self.assertLogs("stock_app.journal", "WARNING"):
+            self.restart()
+        self.assertEqual(len(self.resting()), 2)
@@ -1,14 +1,22 @@
 from django.urls import path
 from .views import StockListCreateView, OrderListCreateView, TradeListView, UserHoldingListView, search_stock
-from . import views
+from . import async_views, views
 from rest_framework.authtoken import views as auth_views
 
 urlpatterns = [
     path('register/', views.UserRegisterView.as_view(), name='register'),
     path('login/', auth_views.obtain_auth_token, name='login'),
+    path('logout/', views.UserLogoutView.as_view(), name='logout'),
     path("stocks/", StockListCreateView.as_view(), name="stocks"),
     path("stocks/search/", search_stock, name="stock-search"),
+    path("stocks/<int:pk>/book/", views.stock_order_book, name="stock-book"),
+    path("stocks/<int:pk>/candles/", views.stock_candles, name="stock-candles"),
     path("orders/", OrderListCreateView.as_view(), name="orders"),
+    path("orders/<int:pk>/", views.OrderDetailView.as_view(), name="order-detail"),
+    path("orders/bulk/", views.BulkOrderCreateView.as_view(), name="orders-bulk"),
+    path("async/orders/", async_views.order_entry, name="orders-async"),
+    path("stream/", async_views.event_stream, name="stream"),
     path("trades/", TradeListView.as_view(), name="trades"),
     path("holdings/", UserHoldingListView.as_view(), name="holdings"),
+    path("portfolio/", views.portfolio, name="portfolio"),
 ]
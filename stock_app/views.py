@@ -1,15 +1,35 @@
-from rest_framework import generics, status, permissions
+from rest_framework import generics, serializers, status, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from django.shortcuts import get_object_or_404
-from .models import Stock, Order, Trade, UserHolding
-from .serializers import StockSerializer, OrderSerializer, TradeSerializer, UserHoldingSerializer, UserRegisterSerializer
-from .services import match_orders
+from .models import Stock, Order, Trade, UserHolding, Candle
+from .serializers import StockSerializer, OrderSerializer, OrderAmendSerializer, TradeSerializer, UserHoldingSerializer, UserRegisterSerializer, CandleSerializer, reserve_order
+from .candles import INTERVAL_SECONDS, CandleAggregator
+from .parsers import NDJSONParser
+from .instrumentation import span
+from .journal import get_journal
+from .orderbook import OPEN_STATUSES, get_book
+from .pagination import IdCursorPagination, TimestampCursorPagination
+from .portfolio import portfolios
+from .generations import STOCK_LIST, data_changed, user_key
+from .responses import responses
+from .risk import accounts
+from .routers import replica_reads
+from .search import get_stock_index
+from .sequencer import submit_order
+from .services import OrderConflict, amend_order, cancel_order
+from concurrent.futures import TimeoutError as MatchingTimeout
+from django.conf import settings
 from django.db import transaction
 from django.contrib.auth import get_user_model
-from django.db.models import Q
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
+from rest_framework.parsers import JSONParser
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+import copy
+import functools
+import json
 from django.contrib.auth import authenticate
 User = get_user_model()
 
@@ -52,48 +72,121 @@ class UserLoginView(APIView):
             )
 
 
+class UserLogoutView(APIView):
+    """Delete the caller's token; it stops authenticating immediately."""
+
+    def post(self, request):
+        if request.auth is not None:
+            request.auth.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ReplicaReadMixin:
+    """Serve ``list`` from a read replica; see ``routers``."""
+
+    read_alias = None
+
+    def list(self, request, *args, **kwargs):
+        with replica_reads(request.user.id) as alias:
+            self.read_alias = alias
+            return super().list(request, *args, **kwargs)
+
+
+class CachedListMixin:
+    """
+    Cache ``list`` responses, with an ETag, until the data behind them
+    changes: ``cache_keys`` names the generation keys they depend on (see
+    ``responses``). A matching If-None-Match gets a 304 without a query;
+    a request sent with Cache-Control: no-cache is always read afresh.
+    Goes before ReplicaReadMixin: only primary reads are cached, as a
+    replica may not have caught up with a change already recorded.
+    """
+    per_user = True
+
+    def cache_keys(self, request):
+        return [user_key(request.user.id)]
+
+    def list(self, request, *args, **kwargs):
+        key = (type(self).__name__, request.user.id if self.per_user else None, request.get_full_path())
+        keys = self.cache_keys(request)
+        entry = None
+        if "no-cache" not in request.headers.get("Cache-Control", ""):
+            entry = responses.get(key, keys)
+        if entry is None:
+            stamp = responses.stamp()
+            response = super().list(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK or self.read_alias is not None:
+                return response
+            entry = responses.put(key, stamp, keys, response.data)
+        etag, data = entry
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        return Response(data, headers={"ETag": etag})
+
+
 # Stocks
-class StockListCreateView(generics.ListCreateAPIView):
+class StockListCreateView(CachedListMixin, ReplicaReadMixin, generics.ListCreateAPIView):
     queryset = Stock.objects.all()
     serializer_class = StockSerializer
     permission_classes = [permissions.IsAuthenticated]
+    per_user = False
+
+    def cache_keys(self, request):
+        return [STOCK_LIST]
 
 # Orders (list + create). 
-class OrderListCreateView(generics.ListCreateAPIView):
+class OrderListCreateView(CachedListMixin, ReplicaReadMixin, generics.ListCreateAPIView):
     queryset = Order.objects.all().order_by("-timestamp")
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = TimestampCursorPagination
 
     def get_queryset(self):
        
         return Order.objects.filter(user=self.request.user).order_by("-timestamp")
 
+    def perform_authentication(self, request):
+        with span("auth"):
+            super().perform_authentication(request)
 
     def create(self, request, *args, **kwargs):
        
         serializer = self.get_serializer(data=request.data, context={'request': request})
         
-        if serializer.is_valid():
+        with span("validate"):
+            valid = serializer.is_valid()
+        if valid:
             try:
                 
                 order = serializer.save(
                     user=request.user,
                     remaining_quantity=serializer.validated_data["quantity"]
                 )
+                accepted = OrderSerializer(order, context={'request': request}).data
                 
-               
-                match_orders(order)
+                # Same-stock orders are matched one at a time by the
+                # sequencer; wait briefly for the result, otherwise just
+                # acknowledge the order.
+                future = submit_order(order)
+                try:
+                    order = future.result(timeout=getattr(settings, "MATCHING_TIMEOUT", 5))
+                except MatchingTimeout:
+                    return Response(accepted, status=status.HTTP_202_ACCEPTED)
                 
                 
                 headers = self.get_success_headers(serializer.data)
+                with span("serialize"):
+                    data = OrderSerializer(order, context={'request': request}).data
                 return Response(
-                    OrderSerializer(order, context={'request': request}).data,
+                    data,
                     status=status.HTTP_201_CREATED, 
                     headers=headers
                 )
                 
+            except serializers.ValidationError as e:
+                # The user can't cover the order (checked when it is saved).
+                return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
             except Exception as e:
-                
                 return Response(
                     {"error": f"Order creation failed: {str(e)}"},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -102,39 +195,229 @@ class OrderListCreateView(generics.ListCreateAPIView):
            
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class OrderDetailView(generics.RetrieveAPIView):
+    """
+    One of the caller's orders: GET it, DELETE to cancel it, PATCH its
+    price and/or quantity. Cancels and amendments are applied by the
+    matching engine in sequence with the stock's other orders.
+    """
+    serializer_class = OrderSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Order.objects.filter(user=self.request.user)
+
+    def delete(self, request, *args, **kwargs):
+        return self.submit(self.get_object(), cancel_order)
+
+    def patch(self, request, *args, **kwargs):
+        order = self.get_object()
+        if order.status not in OPEN_STATUSES:
+            return Response({"error": f"Order {order.id} is {order.status.lower()}."}, status=status.HTTP_409_CONFLICT)
+        serializer = OrderAmendSerializer(order, data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return self.submit(order, functools.partial(amend_order, **serializer.validated_data))
+
+    def submit(self, order, action):
+        accepted = OrderSerializer(order).data
+        future = submit_order(order, action)
+        try:
+            order = future.result(timeout=getattr(settings, "MATCHING_TIMEOUT", 5))
+        except MatchingTimeout:
+            return Response(accepted, status=status.HTTP_202_ACCEPTED)
+        except OrderConflict as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(OrderSerializer(order).data)
+
+class BulkOrderCreateView(APIView):
+    """
+    Place many orders in one request: a JSON array or an NDJSON body.
+
+    The referenced stocks are fetched once for the whole batch and each
+    order reserves from the user's in-memory risk account once it is
+    validated, so the batch as a whole can't over-commit. Valid orders are
+    inserted together and handed to the matching engine in submission
+    order. Results stream back as NDJSON, one line per order, in order.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"error": "Expected a list of orders."}, status=status.HTTP_400_BAD_REQUEST)
+        limit = getattr(settings, "BULK_ORDER_LIMIT", 1000)
+        if len(items) > limit:
+            return Response({"error": f"At most {limit} orders per request."}, status=status.HTTP_400_BAD_REQUEST)
+
+        stock_ids = set()
+        for item in items:
+            try:
+                stock_ids.add(int(item["stock"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        context = {
+            "request": request,
+            "stocks": Stock.objects.in_bulk(stock_ids),
+        }
+
+        results = [None] * len(items)
+        orders = []
+        for index, item in enumerate(items):
+            serializer = OrderSerializer(data=item, context=context)
+            if not serializer.is_valid():
+                results[index] = {"index": index, "status": status.HTTP_400_BAD_REQUEST, "errors": serializer.errors}
+                continue
+            data = serializer.validated_data
+            order = Order(user=request.user, remaining_quantity=data["quantity"], **data)
+            try:
+                reserve_order(order)
+            except serializers.ValidationError as e:
+                results[index] = {"index": index, "status": status.HTTP_400_BAD_REQUEST, "errors": e.detail}
+                continue
+            orders.append((index, order))
+
+        try:
+            Order.objects.bulk_create([order for _, order in orders])
+        except Exception:
+            for _, order in orders:
+                accounts.release(order)
+            raise
+        data_changed([request.user.id])
+        pending = [
+            (index, OrderSerializer(order).data, submit_order(order)) for index, order in orders
+        ]
+        return StreamingHttpResponse(
+            self.stream_results(results, pending), content_type="application/x-ndjson"
+        )
+
+    def stream_results(self, results, pending):
+        timeout = getattr(settings, "MATCHING_TIMEOUT", 5)
+        futures = {index: (accepted, future) for index, accepted, future in pending}
+        for index, result in enumerate(results):
+            if result is None:
+                accepted, future = futures[index]
+                try:
+                    order = future.result(timeout=timeout)
+                    result = {"index": index, "status": status.HTTP_201_CREATED, "order": OrderSerializer(order).data}
+                except MatchingTimeout:
+                    result = {"index": index, "status": status.HTTP_202_ACCEPTED, "order": accepted}
+                except Exception as e:
+                    result = {"index": index, "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                              "error": f"Order creation failed: {str(e)}"}
+            yield json.dumps(result, cls=DjangoJSONEncoder) + "\n"
+
 # Trades
-class TradeListView(generics.ListAPIView):
+class TradeListView(ReplicaReadMixin, generics.ListAPIView):
     queryset = Trade.objects.all().order_by("-timestamp")
     serializer_class = TradeSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = TimestampCursorPagination
+
     def get_queryset(self):
         
-        return Trade.objects.filter(
-            Q(buy_order__user=self.request.user) | Q(sell_order__user=self.request.user)
-        ).order_by("-timestamp")
+        return Trade.objects.for_user(self.request.user).order_by("-timestamp")
 
 # Holdings
-class UserHoldingListView(generics.ListAPIView):
+class UserHoldingListView(CachedListMixin, ReplicaReadMixin, generics.ListAPIView):
     queryset = UserHolding.objects.all()
     serializer_class = UserHoldingSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = IdCursorPagination
 
     def get_queryset(self):
        
-        return UserHolding.objects.filter(user=self.request.user)
+        return UserHolding.objects.filter(user=self.request.user, quantity__gt=0)
+
+# Portfolio: market value, P&L and allocation per holding, plus totals.
+@api_view(["GET"])
+def portfolio(request):
+    return Response(portfolios.get(request.user.id))
+
+# Market data: aggregated book depth, best bid/ask and last trade.
+BOOK_DEFAULT_DEPTH = 10
+BOOK_MAX_DEPTH = 50
+
+
+@api_view(["GET"])
+def stock_order_book(request, pk):
+    if get_stock_index().get(pk) is None:
+        return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        depth = int(request.GET.get("depth", BOOK_DEFAULT_DEPTH))
+    except ValueError:
+        return Response({"detail": "query param 'depth' must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    depth = max(1, min(depth, BOOK_MAX_DEPTH))
+
+    # Fetched first: on first use the journal restores the books it recovered.
+    get_journal()
+    book = get_book(pk)
+    with book.lock:
+        snapshot = book.snapshot(depth)
+    return Response(snapshot)
+
+# OHLCV candles: persisted finished bars plus the open bar from memory.
+CANDLES_DEFAULT_LIMIT = 100
+CANDLES_MAX_LIMIT = 1000
+
+
+@api_view(["GET"])
+def stock_candles(request, pk):
+    if get_stock_index().get(pk) is None:
+        return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+    interval = request.GET.get("interval", "1m")
+    if interval not in INTERVAL_SECONDS:
+        return Response(
+            {"detail": f"query param 'interval' must be one of {', '.join(INTERVAL_SECONDS)}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        limit = int(request.GET.get("limit", CANDLES_DEFAULT_LIMIT))
+    except ValueError:
+        return Response({"detail": "query param 'limit' must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, CANDLES_MAX_LIMIT))
+
+    # Fetched first: on first use the journal restores the books it recovered.
+    get_journal()
+    book = get_book(pk)
+    with book.lock:
+        if book.candles is None:
+            book.candles = CandleAggregator.resume(pk)
+        current = book.candles.current.get(interval)
+        current = copy.copy(current) if current is not None else None
+
+    candles = list(Candle.objects.filter(stock_id=pk, interval=interval).order_by("-start")[:limit])
+    if current is not None:
+        candles = [candle for candle in candles if candle.start != current.start]
+        candles.insert(0, current)
+        candles = candles[:limit]
+    candles.reverse()
+    return Response(CandleSerializer(candles, many=True).data)
 
 # Search endpoint: id exact or name prefix (case-insensitive)
+# Served from the in-process prefix index, never from the database.
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+
 @api_view(["GET"])
 def search_stock(request):
     q = request.GET.get("q", "").strip()
     if q == "":
         return Response({"detail": "query param 'q' required"}, status=status.HTTP_400_BAD_REQUEST)
 
+    try:
+        limit = int(request.GET.get("limit", SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        return Response({"detail": "query param 'limit' must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+
+    index = get_stock_index()
     # if numeric => search by id
     if q.isdigit():
-        stocks = Stock.objects.filter(id=int(q))
+        stock = index.get(int(q))
+        results = [stock] if stock else []
     else:
-        # prefix search: behaves like trie startswith
-        stocks = Stock.objects.filter(name__istartswith=q)
-    serializer = StockSerializer(stocks, many=True)
-    return Response(serializer.data)
\ No newline at end of file
+        results = index.search(q, limit)
+    return Response(results)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'stock_app.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +86,50 @@ DATABASES = {
     }
 }
 
+# Pragmas run on every new SQLite connection (other backends ignore them);
+# {} keeps SQLite's defaults.
+SQLITE_PRAGMAS = {
+    "mmap_size": 268435456,    # 256 MB
+    "cache_size": -65536,      # in KiB when negative: 64 MB
+    "busy_timeout": 5000,      # ms to wait for a lock before failing
+}
+# WAL lets readers carry on while an order is being written instead of
+# waiting for the database-wide write lock. It is stored in the database
+# file itself, so it is opt-in (SQLITE_WAL=1) to leave the committed dev
+# database alone; bench_matching turns it on for its throw-away database.
+SQLITE_WAL_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",   # fsync at checkpoints, not on every commit
+}
+if os.environ.get("SQLITE_WAL"):
+    SQLITE_PRAGMAS.update(SQLITE_WAL_PRAGMAS)
+
+# PostgreSQL, for production: set POSTGRES_DB (plus POSTGRES_USER,
+# POSTGRES_PASSWORD, POSTGRES_HOST and POSTGRES_PORT as needed). Connections
+# are kept open for CONN_MAX_AGE seconds, or taken from a psycopg pool of up
+# to POSTGRES_POOL_SIZE connections when that is set (needs psycopg[pool]).
+if os.environ.get("POSTGRES_DB"):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ["POSTGRES_DB"],
+        'USER': os.environ.get("POSTGRES_USER", "postgres"),
+        'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ""),
+        'HOST': os.environ.get("POSTGRES_HOST", "localhost"),
+        'PORT': os.environ.get("POSTGRES_PORT", "5432"),
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if os.environ.get("POSTGRES_POOL_SIZE"):
+        DATABASES['default']['OPTIONS'] = {
+            'pool': {'min_size': 2, 'max_size': int(os.environ["POSTGRES_POOL_SIZE"]), 'timeout': 10},
+        }
+    else:
+        DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get("CONN_MAX_AGE", 60))
+    # Read replicas for the list endpoints, e.g. POSTGRES_REPLICA_HOSTS=db-r1,db-r2.
+    for index, host in enumerate(filter(None, os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",")), 1):
+        DATABASES[f'replica{index}'] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['stock_app.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -125,11 +171,57 @@ AUTH_USER_MODEL = "stock_app.User"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'stock_app.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
-}
\ No newline at end of file
+}
+
+# Matching engine
+# Orders are matched by one worker thread per shard, partitioned by stock.
+# 0 matches inline in the request thread.
+MATCHING_SHARDS = 4
+# Seconds order placement waits for the match before answering 202 Accepted.
+MATCHING_TIMEOUT = 5
+# Largest batch accepted by /api/orders/bulk/.
+BULK_ORDER_LIMIT = 1000
+# Append-only journal of matching passes with periodic book snapshots, used
+# to rebuild the order books on restart. None disables it.
+MATCHING_JOURNAL = {
+    "DIR": None,
+    "FSYNC_INTERVAL": 0.05,
+    "SNAPSHOT_EVERY": 10000,
+}
+# Events buffered per /api/stream/ connection before a slow client is dropped.
+EVENT_QUEUE_SIZE = 1000
+
+# Per-request and hot-path timing/query metrics, scraped from /metrics.
+# Keep /metrics off the public network when this is on.
+INSTRUMENTATION_ENABLED = False
+
+# Cached token authentication: TTL in seconds, local LRU size and an
+# optional CACHES alias shared between processes.
+TOKEN_AUTH_CACHE = {
+    "TTL": 60,
+    "MAX_SIZE": 10000,
+    "SHARED_CACHE": None,
+}
+
+# Users whose /api/portfolio/ valuation is cached in this process.
+PORTFOLIO_CACHE_SIZE = 10000
+
+# Read replicas (DATABASES aliases) for the list endpoints. A user's reads
+# stay on the primary for STICKY_SECONDS after they submit an order, with
+# the pin kept in an optional CACHES alias shared between processes.
+READ_REPLICAS = {
+    "ALIASES": [alias for alias in DATABASES if alias != "default"],
+    "STICKY_SECONDS": 5,
+    "SHARED_CACHE": None,
+}
+
+# Cached /api/stocks/, /api/orders/ and /api/holdings/ responses (ETag/304)
+# kept in this process.
+RESPONSE_CACHE_SIZE = 10000